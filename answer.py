@@ -1,4 +1,26 @@
+import codecs
+import csv
+import gc
+import gzip
+import hashlib
 import io
+import lzma
+import mmap
+import os
+import random
+import select
+import signal
+import socket
+import struct
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from abc import ABC, abstractmethod
 
 from flask import (
     Flask,
@@ -9,12 +31,27 @@ from flask import (
     jsonify,
     render_template,
     flash,
-    send_file,
+    g,
+    has_request_context,
+    make_response,
+    Response,
 )
 import re
 import json
+import multiprocessing
+import sqlite3
 import statistics
-from datetime import datetime
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from itertools import count, groupby, islice, repeat
+from datetime import date, datetime, timedelta
+
+from werkzeug.serving import BaseWSGIServer
 
 
 class IncorrectInput(Exception):
@@ -25,6 +62,10 @@ class FieldDecodeError(Exception):
     pass
 
 
+class BookRetired(Exception):  # правка пришла в версию книги, которую уже заменили
+    pass
+
+
 def index_error_decorator(function):
     def inner(*args):
         try:
@@ -46,6 +87,12 @@ class DataField:
     def to_json(self):
         return {"value": self.value, "field_name": self.field_description}
 
+    @classmethod
+    def restore(cls, value):  # уже проверенное значение из снимка, без validate
+        field = cls.__new__(cls)
+        field.value = value
+        return field
+
     def validate(self, value):
         self.value = value
 
@@ -99,6 +146,14 @@ class PhoneField(DataField):
         self.phone_number = phone
         self.value = f"+{self.country_code}{self.operator_code}{self.phone_number}"
 
+    @classmethod
+    def restore(cls, value):
+        field = super().restore(value)
+        field.country_code = value[1:3]
+        field.operator_code = value[3:6]
+        field.phone_number = value[6:]
+        return field
+
 
 class EmailField(DataField):
     field_description = "Email"
@@ -120,6 +175,8 @@ REGISTERED_FIELDS = {
 
 
 def field_decoder(field_dict):
+    if not isinstance(field_dict, dict):
+        raise FieldDecodeError("Wrong message format. Field must be an object")
     try:
         field_class = REGISTERED_FIELDS[field_dict["field_name"]]
         field = field_class(field_dict["value"])
@@ -127,16 +184,439 @@ def field_decoder(field_dict):
         raise FieldDecodeError(
             "Wrong message format. 'field_name' and 'value' required"
         )
+    except (TypeError, AttributeError):  # телефон, почта и дата - только строки
+        raise FieldDecodeError(f"Wrong value type for {field_dict['field_name']}")
     return field
 
 
+def decode_fields(dict_contact):  # поля записи по одному, без сборки контакта
+    if not isinstance(dict_contact, dict) or "fields" not in dict_contact:
+        raise FieldDecodeError("Wrong message format. 'fields' required")
+    field_list = dict_contact["fields"]
+    if field_list:
+        if not isinstance(field_list, list):
+            raise FieldDecodeError("Wrong message format. 'fields' must be a list")
+        for field_dict in field_list:
+            yield field_decoder(field_dict)
+
+
+def iter_json_object(items):  # json.dumps(dict(items)) по кускам
+    yield "{"
+    separator = ""
+    for key, value in items:
+        yield f"{separator}{json.dumps(key)}: {json.dumps(value)}"
+        separator = ", "
+    yield "}"
+
+
+def iter_ndjson(items):  # по строке на контакт, id рядом с полями
+    for key, value in items:
+        yield json.dumps({"id": key, "fields": value["fields"]}) + "\n"
+
+
+def ndjson_blocks(stream, size=1024 * 1024):  # (номер первой строки, блок из целых строк)
+    tail = b""
+    line = 1
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        block, newline, tail = (tail + chunk).rpartition(b"\n")
+        if newline:
+            yield line, block
+            line += block.count(b"\n") + 1
+    if tail.strip():
+        yield line, tail
+
+
+def decode_ndjson(task):
+    # выполняется в рабочем процессе; назад передаются проверенные значения
+    # полей, а не объекты Contact - их распаковка дороже самого разбора
+    first_line, block = task
+    result = []
+    for number, line in enumerate(block.split(b"\n"), first_line):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise IncorrectInput("expected a JSON object")
+            contact = contact_from_json(record)
+        except (IncorrectInput, FieldDecodeError, ValueError) as error:
+            raise IncorrectInput(f"NDJSON line {number}: {error}")
+        fields = [(field.field_description, field.value) for field in contact.fields]
+        result.append((record.get("id"), fields))
+    return result
+
+
+def ndjson_contacts(stream, workers=None):
+    # (uid, контакт) в порядке строк; блоки разбираются в отдельных процессах,
+    # в работе не больше двух блоков на процесс
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        batches = map(decode_ndjson, ndjson_blocks(stream))
+    else:
+        batches = parallel_map(decode_ndjson, ndjson_blocks(stream), workers)
+    for batch in batches:
+        for uid, fields in batch:
+            yield uid, restore_contact(fields)
+
+
+IMPORT_BATCH = 5000  # записей CSV/vCard в одной задаче рабочего процесса
+IMPORT_MAX_ERRORS = 1000  # ошибок в отчёте импорта, остальные только считаются
+VCARD_FIELDS = {"FN": "Name", "TEL": "Phone", "EMAIL": "Email", "NOTE": "Note"}
+VCARD_ESCAPE = re.compile(r"\\(.)")
+
+
+def batches(items, size=IMPORT_BATCH):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+def utf8_lines(stream, bad_lines, size=1024 * 1024):
+    # строки файла в UTF-8 (BOM в начале пропускается); номер строки не в UTF-8
+    # попадает в bad_lines, а сама она - с заменой байтов, чтобы разбор шёл дальше
+    tail = b""
+    number = 0
+    while True:
+        chunk = stream.read(size)
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        if not chunk and tail:  # последняя строка без перевода
+            lines.append(tail)
+        for line in lines:
+            if not number and line.startswith(codecs.BOM_UTF8):
+                line = line[len(codecs.BOM_UTF8):]
+            number += 1
+            try:
+                yield line.decode("utf-8") + "\n"
+            except UnicodeDecodeError:
+                bad_lines.add(number)
+                yield line.decode("utf-8", "replace") + "\n"
+        if not chunk:
+            return
+
+
+def csv_rows(stream):  # (номер строки, (колонки, значения)), колонки - имена полей
+    bad_lines = set()
+    reader = csv.reader(utf8_lines(stream, bad_lines))
+    field_names = {field_name.lower(): field_name for field_name in REGISTERED_FIELDS}
+    field_names["id"] = "id"
+    # незнакомые колонки (None) пропускаются, как свойства vCard без поля
+    columns = [field_names.get(column.strip().lower()) for column in next(reader, [])]
+    if bad_lines:  # без заголовка не разобрать ни одной строки - до импорта
+        raise IncorrectInput("CSV header is not UTF-8 text")
+    for row in reader:
+        if bad_lines:  # строка не в UTF-8 - ошибка этой записи в отчёте
+            bad_lines.clear()
+            row = None
+        yield reader.line_num, (columns, row)
+
+
+def csv_record(payload):
+    columns, row = payload
+    if row is None:
+        raise IncorrectInput("Row is not UTF-8 text")
+    uid, fields = None, []
+    for column, value in zip(columns, row):
+        value = value.strip()
+        if column is None or not value:
+            continue
+        if column == "id":
+            uid = value
+        else:
+            fields.append((column, value))
+    return uid, fields
+
+
+def vcard_cards(stream):  # (номер строки BEGIN, строки карточки без переносов)
+    card, start = None, 0
+    bad_lines = set()
+    for number, line in enumerate(utf8_lines(stream, bad_lines), 1):
+        line = line.rstrip("\r\n")
+        if card is not None and line[:1] in (" ", "\t"):  # продолжение свёрнутой строки
+            if card:
+                card[-1] += line[1:]
+            else:  # сразу после BEGIN продолжать нечего - это первая строка карточки
+                card.append(line[1:])
+        elif line.upper() == "BEGIN:VCARD":
+            card, start = [], number
+            bad_lines.clear()  # строки вне карточек не важны
+        elif line.upper() == "END:VCARD" and card is not None:
+            yield start, None if bad_lines else card  # None - карточка не в UTF-8
+            card = None
+        elif card is not None:
+            card.append(line)
+
+
+def vcard_record(lines):
+    if lines is None:
+        raise IncorrectInput("Card is not UTF-8 text")
+    uid, fields = None, []
+    for line in lines:
+        name, _, value = line.partition(":")
+        prop = name.split(";", 1)[0].rsplit(".", 1)[-1].upper()
+        value = VCARD_ESCAPE.sub(
+            lambda match: "\n" if match.group(1) in "nN" else match.group(1), value
+        )
+        if prop == "UID":
+            uid = value
+        elif prop == "BDAY":
+            fields.append(("Birthday", vcard_date(value)))
+        elif prop in VCARD_FIELDS:
+            fields.append((VCARD_FIELDS[prop], value))
+    return uid, fields
+
+
+def vcard_date(value):  # BDAY в формате vCard -> dd.mm.yyyy, как ждёт BirthdayField
+    for date_format in ("%Y-%m-%d", "%Y%m%d"):
+        try:
+            return datetime.strptime(value, date_format).strftime("%d.%m.%Y")
+        except ValueError:
+            pass
+    return value
+
+
+def validate_batch(task):
+    # выполняется в рабочем процессе: разбор и проверка записей, ошибки по строкам
+    parse, records = task
+    contacts, errors = [], []
+    for line, payload in records:
+        try:
+            uid, raw_fields = parse(payload)
+            contact = Contact()
+            for field_name, value in raw_fields:
+                contact.add(REGISTERED_FIELDS[field_name](value))
+        except (IncorrectInput, ValueError) as error:
+            errors.append((line, str(error)))
+            continue
+        fields = [(field.field_description, field.value) for field in contact.fields]
+        contacts.append((uid, fields))
+    return contacts, errors
+
+
+def import_records(parse, records, report, workers=None):
+    # (uid, контакт) из записей CSV/vCard; ошибочные записи пропускаются
+    # и попадают в report, импорт не прерывается
+    workers = workers or os.cpu_count() or 1
+    tasks = ((parse, batch) for batch in batches(records))
+    if workers == 1:
+        results = map(validate_batch, tasks)
+    else:
+        results = parallel_map(validate_batch, tasks, workers)
+    for contacts, errors in results:
+        report["error_count"] += len(errors)
+        for line, message in errors[:IMPORT_MAX_ERRORS - len(report["errors"])]:
+            report["errors"].append({"line": line, "error": message})
+        for uid, fields in contacts:
+            yield uid, restore_contact(fields)
+
+
+PROCESS_POOLS = {}  # число процессов -> пул, общий для всех запросов процесса
+PROCESS_POOLS_LOCK = threading.Lock()
+
+
+def process_pool(workers):
+    # процессы пула не форкаются от многопоточного сервера: на POSIX их
+    # порождает однопоточный forkserver, на Windows - spawn
+    with PROCESS_POOLS_LOCK:
+        executor = PROCESS_POOLS.get(workers)
+        if executor is None:
+            method = "forkserver" if os.name == "posix" else "spawn"
+            executor = ProcessPoolExecutor(workers, multiprocessing.get_context(method))
+            PROCESS_POOLS[workers] = executor
+        return executor
+
+
+def parallel_map(function, items, workers):  # как map, но в workers процессах
+    executor = process_pool(workers)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:  # упавший процесс ломает весь пул, следующий запрос создаст новый
+        with PROCESS_POOLS_LOCK:
+            if PROCESS_POOLS.get(workers) is executor:
+                del PROCESS_POOLS[workers]
+        raise
+    finally:
+        for future in pending:  # ошибка или брошенный генератор: остаток не нужен
+            future.cancel()
+
+
+def chunked(pieces, size=64 * 1024):  # склеивает мелкие куски в байтовые блоки
+    buffer = []
+    buffered = 0
+    for piece in pieces:
+        buffer.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield "".join(buffer).encode()
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+# сжатие выгрузки: имя формата -> (компрессор, тип содержимого)
+DUMP_FORMATS = {
+    "gzip": (lambda: zlib.compressobj(wbits=31), "application/gzip"),
+    "xz": (lzma.LZMACompressor, "application/x-xz"),
+}
+# сигнатуры сжатых файлов для /load
+COMPRESSED_FILES = {b"\x1f\x8b": gzip.open, b"\xfd7zXZ\x00": lzma.open}
+
+
+def compressed(blocks, compressor):  # потоковое сжатие, блоки не накапливаются
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class PrefixedReader:
+    # возвращает в поток байты, уже прочитанные для проверки сигнатуры
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if 0 <= size <= len(self.prefix):
+            chunk, self.prefix = self.prefix[:size], self.prefix[size:]
+            return chunk
+        chunk, self.prefix = self.prefix, b""
+        return chunk + self.stream.read(-1 if size < 0 else size - len(chunk))
+
+
+def decompressing(stream):  # gzip и xz распаковываются на лету, JSON читается как есть
+    size = max(len(magic) for magic in COMPRESSED_FILES)
+    head = b""
+    while len(head) < size:
+        chunk = stream.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    stream = PrefixedReader(head, stream)
+    for magic, open_file in COMPRESSED_FILES.items():
+        if head.startswith(magic):
+            return open_file(stream)
+    return stream
+
+
+class JSONObjectReader:
+    # Разбирает верхний JSON-объект по одной паре (ключ, значение),
+    # не читая весь поток в память. С raw=True значения отдаются
+    # исходным текстом JSON
+    WHITESPACE = re.compile(r"\s*")
+    NUMBER_TAIL = set("0123456789.eE+-")
+    MAX_VALUE = 64 * 1024 * 1024  # символов в одном значении
+
+    def __init__(self, stream, chunk_size=64 * 1024, raw=False):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.raw = raw
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.eof = False
+
+    def _read(self, size=None):
+        chunk = self.stream.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final=self.eof)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return not self.eof
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self.buffer, self.position)
+
+    def _skip_whitespace(self):
+        while True:
+            self.position = self.WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or self.eof or not self._read():
+                return
+
+    def _expect(self, chars):
+        self._skip_whitespace()
+        if self.position >= len(self.buffer):
+            raise self._error("Unexpected end of JSON")
+        char = self.buffer[self.position]
+        if char not in chars:
+            raise self._error(f"Expecting one of {chars!r}")
+        self.position += 1
+        return char
+
+    def _truncated(self, error):  # ошибку могло дать только обрезанное значение
+        # обрезанные литерал, число или \uXXXX кончаются у самого конца буфера
+        return error.msg.startswith("Unterminated string") or error.pos >= len(self.buffer) - 6
+
+    def _value(self, raw=False):
+        self._skip_whitespace()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError as error:
+                if self.eof or not self._truncated(error):
+                    raise
+            else:
+                # число в конце буфера может быть обрезано: "1.5e" читается как 1.5
+                if self.eof or (
+                    end < len(self.buffer) and self.buffer[end] not in self.NUMBER_TAIL
+                ):
+                    if raw:
+                        value = self.buffer[self.position:end]
+                    self.position = end
+                    return value
+            if len(self.buffer) - self.position > self.MAX_VALUE:
+                raise self._error("Value too large")
+            # длинное значение дочитывается вдвое большими кусками: буфер
+            # копируется и разбирается заново O(log n) раз, а не на каждые 64 КБ
+            self._read(size)
+            size *= 2
+
+    def __iter__(self):
+        self._expect("{")
+        self._skip_whitespace()
+        if self.buffer.startswith("}", self.position):
+            self.position += 1
+        else:
+            while True:
+                key = self._value()
+                if not isinstance(key, str):
+                    raise self._error("Expecting property name")
+                self._expect(":")
+                yield key, self._value(self.raw)
+                if self._expect(",}") == "}":
+                    break
+        self._skip_whitespace()
+        if self.position < len(self.buffer):
+            raise self._error("Extra data")
+
+
 class Contact:
+    retired = False  # контакт заменённой версии книги, см. AddressBook.detach
+
     def __init__(self):
         self.fields = []
         self.phone = ""
         self.birthday = ""
         self.mail = ""
         self.note = ""
+        self.book = None
+        self.contact_id = None
 
     def __len__(self):
         return len(self.fields)
@@ -151,11 +631,8 @@ class Contact:
         return {"fields": [field.to_json() for field in self.fields]}
 
     def from_json(self, dict_contact):
-        field_list = dict_contact["fields"]
-        if field_list:
-            for field_dict in field_list:
-                field = field_decoder(field_dict)
-                self.add(field)
+        for field in decode_fields(dict_contact):
+            self.add(field)
 
     def get_birthday(self):
         for field in self.fields:
@@ -190,24 +667,67 @@ class Contact:
                 return field.value
         return ""
 
+    def _locked(self):  # изменение и запись в журнал - под замком книги
+        if self.book is None and self.contact_id is None:  # новый, ещё не в книге
+            return nullcontext()
+        return self._attached(self.book)
+
+    @contextmanager
+    def _attached(self, book):
+        with book.lock if book is not None else nullcontext():
+            # пока ждали замка, контакт могли заменить, удалить или отцепить
+            # вместе с версией книги: такая правка не попала бы в журнал
+            if self.book is not book or (book is None and self.contact_id is not None):
+                if self.retired:
+                    raise BookRetired("The address book was replaced, repeat the request")
+                raise KeyError(f"contact {self.contact_id} was replaced or deleted")
+            yield
+
+    def _changing(self):  # до изменения: книга сохранит прежний вид для своих снимков
+        if self.book is not None:
+            self.book.contact_changing(self)
+
+    def _changed(self, record):  # сообщить книге: переиндексировать и записать в журнал
+        if self.book is not None:
+            self.book.contact_changed(self, record)
+
     def add(self, field_item):
-        self.fields.append(field_item)
-        return self.fields.index(field_item)
+        with self._locked():
+            self._changing()
+            self.fields.append(field_item)
+            self._changed({"op": "field_add", "field": field_item.to_json()})
+            return self.fields.index(field_item)
 
     @index_error_decorator
     def replace(self, index, field_item):
-        self.fields[index] = field_item
+        with self._locked():
+            self.fields[index]  # IndexError - до _changing, контакт не меняется
+            self._changing()
+            self.fields[index] = field_item
+            self._changed(
+                {"op": "field_replace", "idx": index, "field": field_item.to_json()}
+            )
 
     @index_error_decorator
     def delete(self, idx):
         idx = int(idx)
-        self.fields.pop(idx)
+        with self._locked():
+            self.fields[idx]
+            self._changing()
+            self.fields.pop(idx)
+            self._changed({"op": "field_delete", "idx": idx})
 
     @index_error_decorator
     def update(self, field_idx, value):
         field_idx = int(field_idx)
-        field = self.fields[field_idx]
-        field.validate(value)
+        with self._locked():
+            field = self.fields[field_idx]
+            type(field)(value)  # проверка на копии: ошибка - до _changing
+            self._changing()
+            field.validate(value)
+            self._changed(
+                {"op": "field_update", "idx": field_idx, "value": field.value}
+            )
 
     def field_search(self, field_name, search_value):
         for field in self.fields:
@@ -232,68 +752,2350 @@ class Contact:
         return self.name()
 
 
-class AddressBook:
+def ngrams(text, n=3):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def intersect(postings):
+    if not postings:
+        return set()
+    result = set(postings[0])
+    for posting in postings[1:]:
+        if not result:
+            break
+        result &= posting
+    return result
+
+
+class ContactIndex(ABC):
+    # Ключи контакта не хранятся: remove вычисляет их по тем же полям, поэтому
+    # книга снимает контакт с индекса до изменения, а добавляет - после
+    building = False
+
+    @abstractmethod
+    def contact_keys(self, contact):
+        pass
+
+    @abstractmethod
+    def insert(self, key, contact_id):
+        pass
+
+    @abstractmethod
+    def discard(self, key, contact_id):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    def begin(self):  # массовое добавление: отсортированные массивы - одним sort в finish
+        self.building = True
+
+    def finish(self):
+        self.building = False
+
+    def add(self, contact_id, contact):
+        for key in self.contact_keys(contact):
+            self.insert(key, contact_id)
+
+    def remove(self, contact_id, contact):
+        for key in self.contact_keys(contact):
+            self.discard(key, contact_id)
+
+
+class NgramIndex(ContactIndex):
+    # n-граммы всех полей контакта. Запрос короче n символов индекс не сужает.
+    # Ключ - (имя поля, n-грамма) для первого поля каждого типа - его и смотрит
+    # поиск по полю; остальные поля - под (None, n-грамма). Каждая n-грамма поля
+    # хранится один раз, поэтому памяти почти столько же, сколько у общего индекса
+    FIELD_NAMES = (*REGISTERED_FIELDS, None)
+
+    def __init__(self, n=3):
+        self.n = n
+        self.postings = {}
+
+    def contact_keys(self, contact):
+        keys = set()
+        seen = set()
+        for field in contact.fields:
+            field_name = field.field_description
+            if field_name in seen:
+                field_name = None
+            else:
+                seen.add(field_name)
+            if isinstance(field.value, str):
+                keys.update((field_name, gram) for gram in ngrams(field.value, self.n))
+        return keys
+
+    def insert(self, key, contact_id):
+        self.postings.setdefault(key, set()).add(contact_id)
+
+    def discard(self, key, contact_id):
+        posting = self.postings.get(key)
+        if posting is not None:
+            posting.discard(contact_id)
+            if not posting:
+                del self.postings[key]
+
+    def lookup(self, query, field_name):  # query не короче n
+        postings = []
+        for gram in ngrams(query, self.n):
+            posting = self.postings.get((field_name, gram))
+            if not posting:
+                return []
+            postings.append(posting)
+        return sorted(postings, key=len)
+
+    def candidates(self, query):  # подстрока целиком лежит в одном поле
+        result = set()
+        for field_name in self.FIELD_NAMES:
+            found = intersect(self.lookup(query, field_name))
+            if len(found) > len(result):
+                found, result = result, found
+            result |= found
+        return result
+
+    def clear(self):
+        self.postings.clear()
+
+
+class PhoneIndex(ContactIndex):
+    # отсортированный массив нормализованных номеров для поиска по префиксу
     def __init__(self):
+        self.numbers = []
+        self.operators = {}
+
+    def contact_keys(self, contact):
+        return {
+            (field.country_code, field.operator_code, field.phone_number)
+            for field in contact.fields
+            if isinstance(field, PhoneField)
+        }
+
+    def insert(self, key, contact_id):
+        if self.building:
+            self.numbers.append(("".join(key), contact_id))
+        else:
+            insort(self.numbers, ("".join(key), contact_id))
+        self.operators.setdefault(key[1], set()).add(contact_id)
+
+    def discard(self, key, contact_id):
+        item = ("".join(key), contact_id)
+        position = bisect_left(self.numbers, item)
+        if position < len(self.numbers) and self.numbers[position] == item:
+            del self.numbers[position]
+        ids = self.operators.get(key[1])
+        if ids is not None:
+            ids.discard(contact_id)
+            if not ids:
+                del self.operators[key[1]]
+
+    def prefix(self, digits, operator_code=None):  # оператор - того же номера
+        return {
+            contact_id
+            for number, contact_id in self._scan(digits, str.startswith)
+            if operator_code in (None, number[2:5])
+        }
+
+    def exact(self, digits):
+        return {contact_id for _, contact_id in self._scan(digits, str.__eq__)}
+
+    def _scan(self, digits, match):
+        position = bisect_left(self.numbers, (digits,))
+        while position < len(self.numbers) and match(self.numbers[position][0], digits):
+            yield self.numbers[position]
+            position += 1
+
+    def operator(self, operator_code):
+        return set(self.operators.get(operator_code, ()))
+
+    def finish(self):
+        self.numbers.sort()
+        super().finish()
+
+    def clear(self):
+        self.numbers.clear()
+        self.operators.clear()
+
+
+class BirthdayIndex(ContactIndex):
+    # отсортированный по (месяц, день) массив первых дат рождения контактов
+    def __init__(self):
+        self.birthdays = []
+
+    def contact_keys(self, contact):
+        value = contact.get_birthday()
+        if value is None:
+            return set()
+        day, month, _ = value.split(".")  # формат уже проверен BirthdayField
+        return {(int(month), int(day))}
+
+    def insert(self, key, contact_id):
+        if self.building:
+            self.birthdays.append((*key, contact_id))
+        else:
+            insort(self.birthdays, (*key, contact_id))
+
+    def discard(self, key, contact_id):
+        item = (*key, contact_id)
+        position = bisect_left(self.birthdays, item)
+        if position < len(self.birthdays) and self.birthdays[position] == item:
+            del self.birthdays[position]
+
+    def between(self, first, last):
+        start = bisect_left(self.birthdays, first)
+        end = bisect_left(self.birthdays, (last[0], last[1] + 1))
+        return self.birthdays[start:end]
+
+    def upcoming(self, today, days):
+        windows = birthday_windows(today, days)
+        if windows is None:
+            window = self.birthdays
+        else:
+            window = [
+                item for first, last in windows for item in self.between(first, last)
+            ]
+        return upcoming_dates(window, today, days)
+
+    def finish(self):
+        self.birthdays.sort()
+        super().finish()
+
+    def clear(self):
+        self.birthdays.clear()
+
+
+def is_leap_year(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def birthday_in(year, month, day):
+    if (month, day) == (2, 29) and not is_leap_year(year):
+        return date(year, 2, 28)  # 29 февраля отмечаем 28-го в невисокосный год
+    return date(year, month, day)
+
+
+def next_birthday(month, day, today):
+    birthday = birthday_in(today.year, month, day)
+    if birthday < today:
+        birthday = birthday_in(today.year + 1, month, day)
+    return birthday
+
+
+MAX_BIRTHDAY_DAYS = 366  # дальше год повторяется; огромное days переполнит timedelta
+
+
+def birthday_days(days):
+    return max(0, min(days, MAX_BIRTHDAY_DAYS))
+
+
+def birthday_windows(today, days):  # диапазоны (месяц, день); None - весь год
+    if days >= 365:
+        return None
+    end = today + timedelta(days=days)
+    first = (today.month, today.day)
+    last = (end.month, end.day)
+    if last == (2, 28) and not is_leap_year(end.year):
+        last = (2, 29)
+    if first <= last:
+        return [(first, last)]
+    return [(first, (12, 31)), ((1, 1), last)]  # переход через Новый год
+
+
+def upcoming_dates(window, today, days):  # [(month, day, id)] -> [(дата, id)]
+    end = today + timedelta(days=days)
+    result = []
+    for month, day, contact_id in window:
+        birthday = next_birthday(month, day, today)
+        if birthday <= end:
+            result.append((birthday, contact_id))
+    return sorted(result)
+
+
+def phone_digits(value):
+    digits = re.sub(r"\D", "", value)
+    if digits.startswith("0"):  # номер без кода страны, как в PhoneField
+        digits = "38" + digits
+    return digits
+
+
+class RWLock:
+    # Много читателей или один писатель. with lock - запись, повторный вход
+    # разрешён, писатель может и читать; with lock.reading() - чтение.
+    # Читатель не может стать писателем, ожидающий писатель не пускает
+    # новых читателей, чтобы его не задержал поток поисков
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = {}  # поток -> глубина вложенного чтения
+        self.writer = None
+        self.writes = 0
+        self.waiting_writers = 0
+
+    def acquire(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.writes += 1
+                return
+            if me in self.readers:
+                raise RuntimeError("Can't upgrade a read lock to a write lock")
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.writes = 1
+
+    def release(self):
+        with self.condition:
+            self.writes -= 1
+            if not self.writes:
+                self.writer = None
+                self.condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @contextmanager
+    def reading(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers[me] -= 1
+                if not self.readers[me]:
+                    del self.readers[me]
+                    if not self.readers:
+                        self.condition.notify_all()
+
+
+class SearchCache:
+    # LRU результатов поиска; запись из старого поколения книги считается промахом
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()  # кэш меняют и читатели книги
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] != generation:
+                del self.entries[key]
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation, value):
+        with self.lock:
+            self.entries[key] = (generation, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class Journal:
+    # Журнал изменений книги: по одной JSON-записи на строку, только дописывание
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.file = open(path, "a", encoding="utf-8")
+
+    def append(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        if not os.path.exists(path):
+            return
+        with open(path, "rb+") as file:
+            offset = 0
+            for line in file:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("torn record")
+                    record = json.loads(line)
+                except ValueError:
+                    # недописанная запись после сбоя - отрезаем её
+                    file.truncate(offset)
+                    return
+                offset += len(line)
+                yield record
+
+
+class HashingReader:
+    # читает не больше limit байт и считает их sha256
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        if size < 0 or size > self.limit:
+            size = self.limit
+        chunk = self.stream.read(size)
+        self.limit -= len(chunk)
+        self.sha256.update(chunk)
+        return chunk
+
+
+class CountingReader:
+    # считает прочитанные байты, по ним оценивается прогресс загрузки
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.count += len(chunk)
+        return chunk
+
+
+class BinarySnapshot:
+    # Двоичный снимок для mmap: заголовок, записи контактов, таблица
+    # (id, смещение) по возрастанию id и контрольная сумма таблицы.
+    # Значения полей уже проверены, контакты собираются без validate.
+    # Версия 02 хранит после имён полей внешние id в порядке таблицы.
+    MAGIC = b"ABSNAP02"
+    HEADER = struct.Struct("<8sQQQII")  # ..., names, uids
+    V1_MAGIC = b"ABSNAP01"
+    V1_HEADER = struct.Struct("<8sQQQI")  # magic, count, last_contact_id, index_offset, names
+    FOOTER = struct.Struct("<8sI")  # magic, crc32 таблицы
+    ENTRY = struct.Struct("<QQ")
+    FIELD_COUNT = struct.Struct("<I")
+    FIELD = struct.Struct("<BI")
+    JSON_VALUE = 0x80  # значение не строка и хранится как JSON
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.magic = self.mm[:len(self.MAGIC)]
+        if len(self.mm) < self.HEADER.size:  # оборван на заголовке
+            raise ValueError(f"{path} is not a complete snapshot")
+        if self.magic == self.V1_MAGIC:
+            header = self.V1_HEADER.unpack_from(self.mm) + (0,)
+            names_offset = self.V1_HEADER.size
+        else:
+            header = self.HEADER.unpack_from(self.mm)
+            names_offset = self.HEADER.size
+        magic, count, self.last_contact_id, self.index_offset, names_length, uids_length = (
+            header
+        )
+        self.index_end = self.index_offset + self.ENTRY.size * count
+        if magic not in (self.MAGIC, self.V1_MAGIC) or (
+            self.index_end + self.FOOTER.size != len(self.mm)
+        ):
+            raise ValueError(f"{path} is not a complete snapshot")
+        self.names = json.loads(self.mm[names_offset:names_offset + names_length])
+        self.uids_offset = names_offset + names_length
+        self.uids_length = uids_length
+        footer_magic, crc = self.FOOTER.unpack_from(self.mm, self.index_end)
+        with memoryview(self.mm) as view:
+            table_crc = zlib.crc32(view[self.index_offset:self.index_end])
+        if footer_magic != magic or table_crc != crc:
+            raise ValueError(f"{path} is corrupted")
+
+    def uids(self):  # внешние id в порядке таблицы, None у контактов без него
+        if not self.uids_length:
+            return repeat(None)
+        return json.loads(self.mm[self.uids_offset:self.uids_offset + self.uids_length])
+
+    def table(self):  # (ids, смещения) без разбора самих записей
+        with memoryview(self.mm) as view, view[self.index_offset:self.index_end] as table:
+            if sys.byteorder == "little":
+                with table.cast("Q") as entries:
+                    return entries[::2].tolist(), entries[1::2].tolist()
+            entries = list(self.ENTRY.iter_unpack(table))
+        return [entry[0] for entry in entries], [entry[1] for entry in entries]
+
+    def fields(self, offset):
+        (count,) = self.FIELD_COUNT.unpack_from(self.mm, offset)
+        offset += self.FIELD_COUNT.size
+        for _ in range(count):
+            kind, length = self.FIELD.unpack_from(self.mm, offset)
+            offset += self.FIELD.size
+            value = self.mm[offset:offset + length].decode()
+            offset += length
+            if kind & self.JSON_VALUE:
+                value = json.loads(value)
+            yield self.names[kind & ~self.JSON_VALUE], value
+
+    def to_json(self, offset):
+        return {
+            "fields": [
+                {"value": value, "field_name": field_name}
+                for field_name, value in self.fields(offset)
+            ]
+        }
+
+    def contact(self, offset):
+        return restore_contact(self.fields(offset))
+
+    @classmethod
+    def write(cls, path, contacts, last_contact_id):  # (id, uid, json) по возрастанию id
+        names = list(REGISTERED_FIELDS)
+        kinds = {field_name: kind for kind, field_name in enumerate(names)}
+        names_json = json.dumps(names).encode()
+        uids_json = json.dumps([uid for _, uid, _ in contacts]).encode()
+        table = bytearray()
+        with open(path, "wb") as file:
+            file.write(bytes(cls.HEADER.size))
+            file.write(names_json)
+            file.write(uids_json)
+            offset = cls.HEADER.size + len(names_json) + len(uids_json)
+            for contact_id, _, contact_json in contacts:
+                record = [cls.FIELD_COUNT.pack(len(contact_json["fields"]))]
+                for field in contact_json["fields"]:
+                    kind = kinds[field["field_name"]]
+                    value = field["value"]
+                    if not isinstance(value, str):
+                        kind |= cls.JSON_VALUE
+                        value = json.dumps(value)
+                    data = value.encode()
+                    record += [cls.FIELD.pack(kind, len(data)), data]
+                record = b"".join(record)
+                table += cls.ENTRY.pack(contact_id, offset)
+                file.write(record)
+                offset += len(record)
+            file.write(table)
+            file.write(cls.FOOTER.pack(cls.MAGIC, zlib.crc32(table)))
+            file.seek(0)
+            count = len(table) // cls.ENTRY.size
+            file.write(
+                cls.HEADER.pack(
+                    cls.MAGIC,
+                    count,
+                    last_contact_id,
+                    offset,
+                    len(names_json),
+                    len(uids_json),
+                )
+            )
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class BookStorage:
+    # Снимки книги и сегменты журнала в одном каталоге. Снимок N содержит
+    # все изменения из сегментов журнала с номерами меньше N.
+    SNAPSHOT = "snapshot-{:08d}.bin"
+    JSON_SNAPSHOT = "snapshot-{:08d}.json"  # формат прежних версий, только чтение
+    JOURNAL = "journal-{:08d}.log"
+    KEEP_SNAPSHOTS = 2
+
+    def __init__(self, directory, fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        self.sequence = 0
+        self.generation = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, template, sequence):
+        return os.path.join(self.directory, template.format(sequence))
+
+    def _sequences(self, template):
+        prefix, suffix = template.split("{")[0], template.rsplit("}")[-1]
+        return sorted(
+            int(name[len(prefix):-len(suffix)])
+            for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith(suffix)
+        )
+
+    def _snapshots(self):
+        return sorted(
+            set(self._sequences(self.SNAPSHOT)) | set(self._sequences(self.JSON_SNAPSHOT))
+        )
+
+    def open(self, book, initial_path=None, lazy=False):  # восстановить книгу, начать журнал
+        snapshot = None
+        for sequence in reversed(self._snapshots()):
+            try:
+                self.read_snapshot(book, sequence)
+            except (OSError, ValueError, KeyError, FieldDecodeError, IncorrectInput):
+                book.clear()
+                continue
+            snapshot = sequence
+            break
+        if snapshot is None and initial_path is not None:
+            with open(initial_path, "rb") as file:
+                book.load(file, lazy)
+        journals = [
+            sequence
+            for sequence in self._sequences(self.JOURNAL)
+            if sequence >= (snapshot or 0)
+        ]
+        for sequence in journals:
+            book.replay(self._path(self.JOURNAL, sequence))
+        self.sequence = max(journals + [snapshot or 0])
+        self.generation = book.generation
+        book.journal = Journal(self._path(self.JOURNAL, self.sequence), self.fsync)
+
+    def read_snapshot(self, book, sequence):
+        path = self._path(self.SNAPSHOT, sequence)
+        if os.path.exists(path):
+            book.restore_snapshot(BinarySnapshot(path))
+            return
+        with open(self._path(self.JSON_SNAPSHOT, sequence), "rb") as file:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+            file.seek(max(size - 4096, 0))
+            footer = json.loads(file.read().rstrip(b"\n").rsplit(b"\n", 1)[-1])
+            file.seek(0)
+            reader = HashingReader(file, footer["length"])
+            book.restore(reader, footer["last_contact_id"])
+            if reader.limit or reader.sha256.hexdigest() != footer["sha256"]:
+                raise ValueError(f"snapshot {sequence} is corrupted")
+
+    def checkpoint(self, book):  # записать снимок, если книга изменилась
+        with book.lock:
+            # у заменённой версии журнала нет: её снимок уже не нужен
+            if book.journal is None or book.generation == self.generation:
+                return False
+            # новый сегмент журнала начинается ровно с этого момента
+            book.journal.close()
+            self.sequence += 1
+            book.journal = Journal(self._path(self.JOURNAL, self.sequence), self.fsync)
+            sequence = self.sequence  # после замка replace() может сдвинуть self.sequence
+            snapshot = book.snapshot()
+        # контакты читаются уже без замка, писатели не ждут записи снимка
+        contacts = book.capture(snapshot)
+        self.write_snapshot(sequence, contacts, snapshot.last_contact_id)
+        generation = snapshot.generation
+        self.generation = generation
+        self.compact()
+        return True
+
+    def write_snapshot(self, sequence, contacts, last_contact_id):
+        path = self._path(self.SNAPSHOT, sequence)
+        BinarySnapshot.write(path + ".tmp", contacts, last_contact_id)
+        os.replace(path + ".tmp", path)
+        self._sync_directory()
+
+    def _sync_directory(self):
+        if os.name == "nt":  # каталог там не открыть для fsync, переименование и так надёжно
+            return
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def replace(self, book, replacement):
+        # передать журнал от book к replacement. Снимок replacement пишется
+        # заранее, под замком только переименование и новый сегмент журнала,
+        # поэтому журнал не начнётся раньше снимка, на который он опирается.
+        # Старые снимки удаляет compact() - после публикации замены
+        path = os.path.join(self.directory, "replacement.bin.tmp")
+        BinarySnapshot.write(path, replacement.capture(), replacement.last_contact_id)
+        with book.lock:
+            book.journal.close()
+            book.journal = None
+            book.retired = True  # опоздавшие правки отвергаются, а не теряются без журнала
+            self.sequence += 1
+            os.replace(path, self._path(self.SNAPSHOT, self.sequence))
+            self._sync_directory()
+            replacement.journal = Journal(
+                self._path(self.JOURNAL, self.sequence), self.fsync
+            )
+            self.generation = replacement.generation
+
+    def compact(self):  # удалить старые снимки и ненужные им сегменты журнала
+        snapshots = self._snapshots()
+        kept = snapshots[-self.KEEP_SNAPSHOTS:]
+        for sequence in snapshots[:-self.KEEP_SNAPSHOTS]:
+            for template in (self.SNAPSHOT, self.JSON_SNAPSHOT):
+                if os.path.exists(self._path(template, sequence)):
+                    self._remove(self._path(template, sequence))
+        for sequence in self._sequences(self.JOURNAL):
+            if kept and sequence < kept[0]:
+                self._remove(self._path(self.JOURNAL, sequence))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except PermissionError:
+            # Windows не удаляет файл, пока ленивая книга держит снимок в mmap;
+            # его удалит следующий compact
+            if os.name != "nt":
+                raise
+
+
+class Checkpointer(threading.Thread):
+    # Фоновый поток: периодически пишет снимок текущей версии книги
+    def __init__(self, book, storage, interval):
+        super().__init__(name="checkpointer", daemon=True)
+        self.book = book
+        self.storage = storage
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.storage.checkpoint(self.book.current)
+            except Exception:  # поток снимков не должен умереть от одной ошибки
+                app.logger.exception("Checkpoint failed")
+
+    def stop(self):
+        self.stopped.set()
+
+
+class LoadJob(threading.Thread):
+    # Фоновая загрузка файла: новая книга собирается отдельно, живая книга
+    # всё это время читается как обычно и подменяется целиком в конце
+    MAX_JOBS = 100  # сколько последних заданий помнить для /load/<job_id>
+    JOB_TTL = 3600  # секунд после завершения, пока задание видно в /load/<job_id>
+    jobs = OrderedDict()
+    jobs_lock = threading.Lock()
+
+    def __init__(self, book, path, ndjson=False, workers=None):
+        super().__init__(name="load-job", daemon=True)
+        self.job_id = uuid.uuid4().hex
+        self.book = book
+        self.path = path
+        self.ndjson = ndjson
+        self.workers = workers
+        self.size = os.path.getsize(path)
+        self.reader = None
+        self.state = "queued"
+        self.error = None
+        self.processed = 0
+        self.report = {"error_count": 0, "errors": []}
+        self.started = time.monotonic()
+        self.finished = None
+        with self.jobs_lock:
+            self.jobs[self.job_id] = self
+            self._expire()
+
+    @classmethod
+    def _expire(cls):  # под jobs_lock
+        now = time.monotonic()
+        for job_id, job in list(cls.jobs.items()):
+            if job.finished is not None and now - job.finished > cls.JOB_TTL:
+                del cls.jobs[job_id]
+        while len(cls.jobs) > cls.MAX_JOBS:
+            cls.jobs.popitem(last=False)
+
+    @classmethod
+    def find(cls, job_id):  # None - задания нет или оно истекло
+        with cls.jobs_lock:
+            cls._expire()
+            return cls.jobs.get(job_id)
+
+    def run(self):
+        self.state = "running"
+        replacement = None
+        try:
+            with open(self.path, "rb") as file:
+                self.reader = CountingReader(file)
+                replacement = self.book.blank()
+                replacement.import_contacts(self._entries(decompressing(self.reader)))
+            replacement.wait_indexed()  # опубликованная книга сразу ищет по индексам
+            self.book.swap(replacement)
+            self.state = "done"
+        except Exception as error:  # задание не должно уронить поток молча
+            app.logger.exception("Load job %s failed", self.job_id)
+            self.state = "failed"
+            self.error = str(error)
+            if replacement is not None:
+                replacement.discard()
+        finally:
+            self.finished = time.monotonic()
+            os.remove(self.path)
+
+    def _entries(self, stream):  # (uid, контакт); ошибочные записи - в отчёт
+        if self.ndjson:
+            entries = ndjson_contacts(stream, self.workers)
+        else:
+            entries = self._json_entries(stream)
+        for entry in entries:
+            self.processed += 1
+            yield entry
+
+    def _json_entries(self, stream):
+        for uid, contact_list in JSONObjectReader(stream):
+            try:
+                contact = contact_from_json(contact_list)
+            except (IncorrectInput, FieldDecodeError, ValueError) as error:
+                self.report["error_count"] += 1
+                if len(self.report["errors"]) < IMPORT_MAX_ERRORS:
+                    self.report["errors"].append({"id": uid, "error": str(error)})
+                continue
+            yield uid, contact
+
+    def progress(self):
+        done = self.reader.count if self.reader is not None else 0
+        elapsed = (self.finished or time.monotonic()) - self.started
+        eta = None
+        if self.state == "running" and done:
+            eta = round(elapsed * (self.size - done) / done, 1)
+        return {
+            "job_id": self.job_id,
+            "state": self.state,
+            "processed": self.processed,
+            "error_count": self.report["error_count"],
+            "errors": self.report["errors"],
+            "error": self.error,
+            "bytes_read": done,
+            "bytes_total": self.size,
+            "elapsed": round(elapsed, 1),
+            "eta": eta,
+        }
+
+
+def keyset_page(ids, limit, after=None, before=None):  # ids отсортированы
+    if before is not None:
+        end = bisect_left(ids, before)
+        start = max(end - limit, 0)
+    else:
+        start = 0 if after is None else bisect_right(ids, after)
+        end = start + limit
+    page_ids = ids[start:end]
+    prev_id = page_ids[0] if page_ids and start > 0 else None
+    next_id = page_ids[-1] if page_ids and end < len(ids) else None
+    return page_ids, prev_id, next_id
+
+
+def contact_from_json(dict_contact):
+    contact = Contact()
+    contact.from_json(dict_contact)
+    return contact
+
+
+def peek_contact(contacts, pending, source, contact_id):
+    # контакт книги или её ленивого источника без сборки в книгу; None - нет такого
+    contact = contacts.get(contact_id)
+    if contact is None:
+        raw = pending.get(contact_id)
+        if raw is None:  # другой поток собрал его между двумя проверками
+            return contacts.get(contact_id)
+        contact = source.contact(raw)
+    return contact
+
+
+def restore_contact(fields):  # (field_name, value) уже проверенных полей
+    contact = Contact()
+    contact.fields = [
+        REGISTERED_FIELDS[field_name].restore(value) for field_name, value in fields
+    ]
+    return contact
+
+
+def content_hash(contact_json):  # хэш полей записи, не зависит от порядка ключей
+    fields = json.dumps(contact_json["fields"], sort_keys=True).encode()
+    return hashlib.blake2b(fields, digest_size=16).digest()
+
+
+def uid_tag(uid):  # внешний id в ETag: в нём могут быть кавычки и любые символы
+    return hashlib.blake2b(uid.encode(), digest_size=8).hexdigest()
+
+
+class JSONSource:
+    # источник ленивой книги: исходный текст записи из загруженного JSON;
+    # поля проверяются только при сборке контакта
+    @staticmethod
+    def contact(raw):
+        return contact_from_json(json.loads(raw))
+
+    def to_json(self, raw):
+        return self.contact(raw).to_json()
+
+
+class BookSnapshot:
+    # Вид книги на момент создания для долгих читателей: выгрузки, снимки на
+    # диск. Словари книги не копируются: книга сама копирует их при первом
+    # структурном изменении, а прежний вид изменяемого на месте контакта
+    # сохраняет в overrides. Создаётся через AddressBook.snapshot()
+    def __init__(self, book):
+        self.book = book
+        self.order = book.order
+        self.contacts = book.contacts
+        self.pending = book.pending
+        self.source = book.source
+        self.uids = book.uids
+        self.generation = book.generation
+        self.last_contact_id = book.last_contact_id
+        self.overrides = {}  # id -> to_json контакта до изменения
+
+    def __len__(self):
+        return len(self.order)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.book.snapshots.discard(self)
+
+    def preserve(self, contact):  # вызывается книгой под её замком
+        contact_id = contact.contact_id
+        if contact_id not in self.overrides and self.contacts.get(contact_id) is contact:
+            self.overrides[contact_id] = contact.to_json()
+
+    def uid(self, contact_id):
+        return self.uids.get(contact_id, str(contact_id))
+
+    def contact(self, contact_id):  # контакт, каким он был при снятии снимка; None - не было
+        contact_json = self.overrides.get(contact_id)
+        if contact_json is not None:
+            return contact_from_json(contact_json)
+        return peek_contact(self.contacts, self.pending, self.source, contact_id)
+
+    def contact_json(self, contact_id):
+        with self.book.lock.reading():  # только на время чтения одного контакта
+            contact_json = self.overrides.get(contact_id)
+            if contact_json is not None:
+                return contact_json
+            contact = self.contacts.get(contact_id)
+            if contact is None:
+                raw = self.pending.get(contact_id)
+                if raw is not None:
+                    return self.source.to_json(raw)
+                # _materialize собрал его между двумя проверками (под замком чтения)
+                contact = self.contacts[contact_id]
+            return contact.to_json()
+
+    def items(self):  # (id, json) по возрастанию id
+        for contact_id in self.order:
+            yield contact_id, self.contact_json(contact_id)
+
+
+class AddressBook:
+    INDEX_BATCH = 1000  # контактов за одно взятие замка чтения при построении индексов
+
+    def __init__(self, cache_size=256):
         self.contacts = {}
+        # ленивая книга: id -> сырая запись в self.source, контакт ещё не собран
+        self.pending = {}
+        self.source = None
+        # indexed=False - индексы строит поток indexer, поиск пока перебирает книгу;
+        # dirty - id, изменённые после снимка, с которого он начал
+        self.indexed = True
+        self.indexer = None
+        self.dirty = set()
+        self.order = []  # id контактов по возрастанию, для keyset-пагинации
+        self.uids = {}  # id -> внешний id (ключ записи в загруженном JSON)
+        self.uid_index = {}  # внешний id -> id
+        self.hashes = {}  # id -> хэш содержимого, с которым запись была загружена
         self.last_contact_id = 0
+        self.generation = 0
+        # версии для ETag: id -> generation последнего изменения контакта;
+        # era меняется при очистке и подмене книги, когда id начинаются заново,
+        # epoch - при каждом запуске процесса
+        self.versions = {}
+        self.era = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self.lock = RWLock()  # поиски и страницы читают параллельно, изменения - по одному
+        # ленивая сборка контактов и индексов идёт и под чтением, она - под своим замком
+        self.build_lock = threading.Lock()
+        # открытые снимки; shared - словари книги ещё общие с последним снимком
+        self.snapshots = weakref.WeakSet()
+        self.shared = False
+        self.journal = None
+        self.retired = False  # версию заменили /clear или /load, правки она не принимает
+        self.search_cache = SearchCache(cache_size)
+        self.text_index = NgramIndex()
+        self.phone_index = PhoneIndex()
+        self.birthday_index = BirthdayIndex()
+        self.indexes = [
+            self.text_index,
+            self.phone_index,
+            self.birthday_index,
+        ]
+
+    def _index(self, contact_id, contact):
+        self.generation += 1
+        self.versions[contact_id] = self.generation
+        contact.book = self
+        contact.contact_id = contact_id
+        if self.indexed:
+            for index in self.indexes:
+                index.add(contact_id, contact)
+        else:
+            self.dirty.add(contact_id)
+
+    def _unindex(self, contact_id):
+        self.generation += 1
+        contact = self.contacts.get(contact_id)
+        if contact is not None and contact.book is self:
+            contact.book = None
+        if self.indexed:
+            if contact is None:  # несобранный контакт: ключи - по записи в источнике
+                contact = self.source.contact(self.pending[contact_id])
+            for index in self.indexes:
+                index.remove(contact_id, contact)
+        else:
+            self.dirty.add(contact_id)
+
+    def _peek(self, contact_id):  # перебор ленивой книги не собирает в неё контакты
+        return peek_contact(self.contacts, self.pending, self.source, contact_id)
+
+    def _index_ready(self):  # False - индексы строятся в фоне, искать перебором
+        if self.indexed:
+            return True
+        with self.build_lock:
+            # поток мог не пережить fork или упасть - тогда начинаем заново
+            if not self.indexed and (self.indexer is None or not self.indexer.is_alive()):
+                self.indexer = threading.Thread(
+                    target=self._build_indexes, name="indexer", daemon=True
+                )
+                self.indexer.start()
+        return self.indexed
+
+    def wait_indexed(self):  # индексы готовы, поиск больше не перебирает книгу
+        if not self._index_ready():
+            self.indexer.join()
+
+    def pause_indexing(self):
+        # перед fork: поток с замком чтения не должен достаться рабочему - его
+        # замок остался бы занятым навсегда. Рабочий начнёт построение заново
+        with self.lock:  # поток индексов - между пачками
+            indexer, self.indexer = self.indexer, None
+        if indexer is not None:
+            indexer.join()
+
+    def _build_indexes(self):
+        # Индексы строятся по снимку книги, замок чтения берётся на INDEX_BATCH
+        # контактов, поэтому правки и поиски идут между пачками. Контакты,
+        # изменённые за это время, переиндексируются под замком при установке
+        indexer = threading.current_thread()
+        with self.lock:
+            if self.indexer is not indexer:
+                return
+            snapshot = self.snapshot()
+            self.dirty = set()
+        with snapshot:
+            indexes = [NgramIndex(), PhoneIndex(), BirthdayIndex()]
+            for index in indexes:
+                index.begin()
+            for start in range(0, len(snapshot.order), self.INDEX_BATCH):
+                with self.lock.reading():
+                    if self.indexer is not indexer:  # книгу очистили
+                        return
+                    for contact_id in snapshot.order[start:start + self.INDEX_BATCH]:
+                        contact = snapshot.contact(contact_id)
+                        for index in indexes:
+                            index.add(contact_id, contact)
+            for index in indexes:
+                index.finish()
+            with self.lock:
+                if self.indexer is not indexer:
+                    return
+                for contact_id in self.dirty:
+                    for contact, update in (
+                        (snapshot.contact(contact_id), "remove"),
+                        (self._peek(contact_id), "add"),
+                    ):
+                        if contact is not None:
+                            for index in indexes:
+                                getattr(index, update)(contact_id, contact)
+                self.text_index, self.phone_index, self.birthday_index = indexes
+                self.indexes = indexes
+                self.dirty = set()
+                self.indexer = None
+                self.indexed = True
+
+    def _materialize(self, contact_id):  # собрать контакт ленивой книги при обращении
+        with self.build_lock:
+            contact = self.contacts.get(contact_id)
+            if contact is None:
+                raw = self.pending[contact_id]
+                contact = self.source.contact(raw)
+                contact.book = self
+                contact.contact_id = contact_id
+                self.contacts[contact_id] = contact
+                del self.pending[contact_id]
+            return contact
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = BookSnapshot(self)
+            self.snapshots.add(snapshot)
+            self.shared = True
+            return snapshot
+
+    def _unshare(self):  # перед структурным изменением: снимки сохраняют свои словари
+        if self.shared:
+            if self.snapshots:  # закрытым снимкам прежние словари уже не нужны
+                self.order = list(self.order)
+                self.contacts = dict(self.contacts)
+                self.pending = dict(self.pending)
+                self.uids = dict(self.uids)
+            self.shared = False
+
+    def _writable(self):  # под замком записи, до изменения
+        if self.retired:
+            raise BookRetired("The address book was replaced, repeat the request")
+
+    def retire(self):  # после этого правки старой версии не примут, а не пропадут молча
+        with self.lock:
+            self.retired = True
+
+    def detach(self):
+        # заменённая версия: контакты больше не ссылаются на книгу, и без этих
+        # циклов её освобождает подсчёт ссылок - даже из замороженной кучи.
+        # Под замком: правка, уже проверившая контакт, доходит до книги
+        with self.lock:
+            for contact in list(self.contacts.values()):
+                if contact.book is self:
+                    contact.book = None
+                    contact.retired = True
+
+    def contact_changing(self, contact):  # поля ещё прежние
+        self._writable()
+        for snapshot in list(self.snapshots):
+            snapshot.preserve(contact)
+        if self.indexed:
+            for index in self.indexes:
+                index.remove(contact.contact_id, contact)
+
+    def contact_changed(self, contact, record):
+        self.generation += 1
+        contact_id = contact.contact_id
+        self.versions[contact_id] = self.generation
+        self.hashes.pop(contact_id, None)
+        if self.indexed:
+            for index in self.indexes:
+                index.add(contact_id, contact)
+        else:
+            self.dirty.add(contact_id)
+        self._log({**record, "id": contact_id})
+
+    def _log(self, record):
+        if self.journal is not None:
+            self.journal.append(record)
+
+    def replay(self, path):  # восстановить изменения из журнала
+        for record in Journal.read(path):
+            self.apply(record)
+
+    def apply(self, record):
+        op = record["op"]
+        if op == "clear":
+            self.clear()
+        elif op == "add":
+            self._insert(
+                record["id"], contact_from_json(record["contact"]), record.get("uid")
+            )
+        elif op == "replace":
+            self.replace(record["id"], contact_from_json(record["contact"]))
+        elif op == "delete":
+            self.delete(record["id"])
+        elif op == "field_add":
+            self[record["id"]].add(field_decoder(record["field"]))
+        elif op == "field_replace":
+            self[record["id"]].replace(record["idx"], field_decoder(record["field"]))
+        elif op == "field_delete":
+            self[record["id"]].delete(record["idx"])
+        elif op == "field_update":
+            self[record["id"]].update(record["idx"], record["value"])
+        else:
+            raise FieldDecodeError(f"Unknown journal operation {op}")
 
     def __getitem__(self, key):
-        return self.contacts[key]
+        key = self.resolve(key)
+        contact = self.contacts.get(key)
+        if contact is None:
+            contact = self._materialize(key)
+        return contact
+
+    def resolve(self, key):  # id контакта по UUID или по самому id
+        if isinstance(key, int):
+            return key
+        contact_id = self.uid_index.get(key)
+        if contact_id is not None:
+            return contact_id
+        try:
+            return int(key)
+        except ValueError:
+            raise KeyError(key) from None
+
+    def uid(self, contact_id):  # UUID для ссылок; у старых записей его может не быть
+        return self.uids.get(contact_id, str(contact_id))
+
+    def etag(self):  # версия всей книги, без обхода контактов
+        return f"{self.epoch}-{self.generation}"
+
+    def contact_etag(self, key):
+        # uid - в адресах страницы контакта и меняется, когда ключ переходит к другому
+        with self.lock.reading():
+            contact_id = self.resolve(key)
+            if contact_id not in self.contacts and contact_id not in self.pending:
+                raise KeyError(key)
+            version = self.versions.get(contact_id, 0)
+            uid = self.uid(contact_id)
+        return f"{self.epoch}-{self.era}-{contact_id}-{uid_tag(uid)}-{version}"
 
     def dumps(self):
-        contacts = {rec_id: rec.to_json() for rec_id, rec in self.contacts.items()}
-        return json.dumps(contacts)
-
-    def loads(self, bytes_contacts): #Достать из файла и сделать объектом
-        self.contacts.clear()
-        self.last_contacts_id = 0
-        json_contacts = json.loads(bytes_contacts)
-        for _, contact_list in json_contacts.items():
-            contact = Contact()
-            contact.from_json(contact_list)
-            self.add(contact)
-        
-
-    def add(self, contact):  # Добавить элемент
-        self.contacts[self.last_contact_id] = contact
-        contact_id = self.last_contact_id
-        self.last_contact_id += 1
-        return contact_id
+        return "".join(self.iter_dump())
+
+    def iter_dump(self):  # тот же JSON, что json.dumps, но по одному контакту
+        return iter_json_object(self._iter_uid_json())
+
+    def iter_ndjson(self):
+        return iter_ndjson(self._iter_uid_json())
+
+    def _iter_uid_json(self):
+        with self.snapshot() as snapshot:
+            for contact_id, contact_json in snapshot.items():
+                yield snapshot.uid(contact_id), contact_json
+
+    def _contact_json(self, contact_id):  # несобранный контакт читается из источника
+        raw = self.pending.get(contact_id)
+        if raw is not None:
+            return self.source.to_json(raw)
+        contact = self.contacts.get(contact_id)
+        return None if contact is None else contact.to_json()
+
+    def capture(self, snapshot=None):  # (id, uid, json) всех контактов снимка
+        if snapshot is None:
+            snapshot = self.snapshot()
+        with snapshot:
+            return [
+                (contact_id, snapshot.uids.get(contact_id), contact_json)
+                for contact_id, contact_json in snapshot.items()
+            ]
+
+    def restore_snapshot(self, snapshot):  # ленивая загрузка двоичного снимка
+        with self.lock:
+            self.clear()
+            ids, offsets = snapshot.table()
+            self.source = snapshot
+            self.pending = dict(zip(ids, offsets))
+            self.order = ids
+            self.uids = {
+                contact_id: uid for contact_id, uid in zip(ids, snapshot.uids()) if uid
+            }
+            self.uid_index = {uid: contact_id for contact_id, uid in self.uids.items()}
+            self.last_contact_id = snapshot.last_contact_id
+            self.indexed = False
+            self._index_ready()
+
+    def restore(self, stream, last_contact_id):  # загрузка снимка с сохранением id
+        self.clear()
+        self.indexed = False  # индексы - одним проходом в фоне после загрузки
+        for key, contact_list in JSONObjectReader(stream):
+            self._insert(int(key), contact_from_json(contact_list))
+        self.last_contact_id = last_contact_id
+        self._index_ready()
+
+    def loads(self, bytes_contacts): #Достать из строки и сделать объектом
+        if isinstance(bytes_contacts, str):
+            self.load(io.StringIO(bytes_contacts))
+        else:
+            self.load(io.BytesIO(bytes_contacts))
+
+    def load(self, stream, lazy=False):  # потоковая загрузка из файла, по одному контакту
+        if not lazy:
+            self.clear()
+            self.indexed = False
+            for uid, contact_list in JSONObjectReader(stream):
+                self.add(contact_from_json(contact_list), uid)
+            self._index_ready()
+            return
+        # лениво: запоминаем только текст записи, контакт соберётся при обращении.
+        # Поля проверяются сразу: запись, которая не соберётся, пропускается и
+        # попадает в отчёт, иначе на ней падали бы поиски, выгрузки и снимки.
+        # Словари меняются на месте - всё под замком записи, после _unshare
+        report = {"error_count": 0, "errors": []}
+        with self.lock:
+            self.clear()
+            self.indexed = False
+            self._unshare()
+            self.source = JSONSource()
+            for uid, raw in JSONObjectReader(stream, raw=True):
+                try:
+                    contact_list = json.loads(raw)
+                    for _ in decode_fields(contact_list):
+                        pass
+                except (IncorrectInput, FieldDecodeError) as error:
+                    report["error_count"] += 1
+                    if len(report["errors"]) < IMPORT_MAX_ERRORS:
+                        report["errors"].append({"id": uid, "error": str(error)})
+                    continue
+                contact_id = self.last_contact_id
+                self.last_contact_id += 1
+                self.pending[contact_id] = raw
+                self.order.append(contact_id)
+                self._set_uid(contact_id, uid)
+                if self.journal is not None:
+                    self._log(
+                        {"op": "add", "id": contact_id, "uid": uid, "contact": contact_list}
+                    )
+            self.generation += 1
+            self._index_ready()
+        if report["error_count"]:
+            app.logger.warning(
+                "Lazy load skipped %d invalid records, first: %s",
+                report["error_count"],
+                report["errors"][0],
+            )
+        return report
+
+    def load_ndjson(self, stream, workers=None):  # строки разбираются параллельно
+        self.clear()
+        self.indexed = False
+        for uid, contact in ndjson_contacts(stream, workers):
+            self.add(contact, uid)
+        self._index_ready()
+
+    def blank(self):  # пустая книга того же вида, в ней собирается замена
+        book = AddressBook(self.search_cache.maxsize)
+        book.indexed = False  # индексы замены строятся одним проходом, а не по контакту
+        return book
+
+    def discard(self):  # неудавшаяся замена в памяти уходит вместе с последней ссылкой
+        pass
+
+    def import_contacts(self, entries):  # (uid, контакт): известный uid заменяется
+        count = 0
+        for uid, contact in entries:
+            with self.lock:
+                contact_id = self.uid_index.get(uid)
+                if contact_id is None:
+                    self.add(contact, uid)
+                else:
+                    self.replace(contact_id, contact)
+            count += 1
+        return count
+
+    def merge(self, stream, prune=False):  # слияние по внешнему id без перезагрузки
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        seen = set()
+        for uid, contact_list in JSONObjectReader(stream):
+            if prune:
+                seen.add(uid)
+            digest = content_hash(contact_list)
+            with self.lock:
+                contact_id = self.uid_index.get(uid)
+                if contact_id is None:
+                    contact_id = self.add(contact_from_json(contact_list), uid)
+                    stats["added"] += 1
+                elif digest == self.hashes.get(contact_id) or digest == content_hash(
+                    self._contact_json(contact_id)
+                ):
+                    stats["unchanged"] += 1
+                else:
+                    self.replace(contact_id, contact_from_json(contact_list))
+                    stats["updated"] += 1
+                self.hashes[contact_id] = digest
+        if prune:
+            for contact_id in list(self.order):
+                if self.uids.get(contact_id) not in seen:
+                    self.delete(contact_id)
+                    stats["deleted"] += 1
+        return stats
+
+    def add(self, contact, uid=None):  # Добавить элемент
+        if uid is None:
+            uid = str(uuid.uuid4())
+        with self.lock:
+            contact_id = self.last_contact_id
+            self._insert(contact_id, contact, uid)
+            return contact_id
+
+    def _insert(self, contact_id, contact, uid=None):
+        self._writable()
+        self._unshare()
+        self.contacts[contact_id] = contact
+        self.last_contact_id = max(self.last_contact_id, contact_id + 1)
+        if not self.order or self.order[-1] < contact_id:
+            self.order.append(contact_id)
+        else:
+            insort(self.order, contact_id)
+        self._set_uid(contact_id, uid)
+        self._index(contact_id, contact)
+        record = {"op": "add", "id": contact_id, "contact": contact.to_json()}
+        if uid is not None:
+            record["uid"] = uid
+        self._log(record)
+
+    def _set_uid(self, contact_id, uid):
+        if uid is None:
+            return
+        previous = self.uid_index.get(uid)
+        if previous is not None:  # повтор ключа: запись принадлежит последнему контакту
+            self.uids.pop(previous, None)
+        self.uids[contact_id] = uid
+        self.uid_index[uid] = contact_id
 
     def replace(self, contact_id, contact):   #Заменить
-        if contact_id not in self.contacts:
-            raise KeyError(f"contact {contact_id} not found")
-        self.contacts[contact_id] = contact
+        with self.lock:
+            contact_id = self.resolve(contact_id)
+            if contact_id not in self.contacts and contact_id not in self.pending:
+                raise KeyError(f"contact {contact_id} not found")
+            self._writable()
+            self._unshare()
+            self._unindex(contact_id)
+            self.pending.pop(contact_id, None)
+            self.hashes.pop(contact_id, None)
+            self.contacts[contact_id] = contact
+            self._index(contact_id, contact)
+            self._log({"op": "replace", "id": contact_id, "contact": contact.to_json()})
 
     @index_error_decorator
     def delete(self, contact_id):   #Удалить
-        key = int(contact_id)
-        self.contacts.pop(key)
+        with self.lock:
+            key = self.resolve(contact_id)
+            self._writable()
+            self._unshare()
+            self._unindex(key)
+            if self.contacts.pop(key, None) is None:
+                self.pending.pop(key)
+            del self.order[bisect_left(self.order, key)]
+            self.uid_index.pop(self.uids.pop(key, None), None)
+            self.hashes.pop(key, None)
+            self.versions.pop(key, None)
+            self._log({"op": "delete", "id": key})
+
+    def page(self, limit, after=None, before=None, ids=None):  # keyset-пагинация по id
+        with self.lock.reading():
+            page_ids, prev_id, next_id = keyset_page(
+                self.order if ids is None else ids, limit, after, before
+            )
+            contacts = {contact_id: self[contact_id] for contact_id in page_ids}
+        return contacts, prev_id, next_id
+
+    def _cached_search(self, key, search, *args, **kwargs):
+        with self.lock.reading():
+            result = self.search_cache.get(key, self.generation)
+            if result is None:
+                generation = self.generation
+                result = search(*args, **kwargs)
+                self.search_cache.put(key, generation, result)
+            return dict(result)
 
     def str_search(self, search_str: str):   #поиск строки
+        return self._cached_search(("all", search_str), self._str_search, search_str)
+
+    def multiple_search(self, **search_items): # множественный поиск
+        key = ("fields", tuple(sorted(search_items.items())))
+        return self._cached_search(key, self._multiple_search, **search_items)
+
+    def _str_search(self, search_str):  # по триграммному индексу
+        if len(search_str) >= self.text_index.n and self._index_ready():
+            candidates = sorted(self.text_index.candidates(search_str))
+        else:  # индекс не сужает или ещё строится: перебор
+            candidates = self.order
         result = {}
-        for contact_id, contact in self.contacts.items():
-            if search_str in contact:
-                result[contact_id] = contact
+        for contact_id in candidates:
+            if search_str in self._peek(contact_id):
+                result[contact_id] = self[contact_id]
         return result
 
-    def multiple_search(self, **search_items): # множественный поиск (убрать, т.к. указатели)
+    def _multiple_search(self, **search_items):
+        # кандидаты - по n-граммам первого поля нужного типа; подстроку проверяет multiple_search
+        if not search_items:
+            return {contact_id: self[contact_id] for contact_id in self.order}
+        if not search_items.keys() <= REGISTERED_FIELDS.keys():
+            return {}
+        postings = []
+        if self._index_ready():  # иначе - перебор всей книги
+            for field_name, search_value in search_items.items():
+                if len(search_value) < self.text_index.n:  # короткое значение проверит фильтр ниже
+                    continue
+                field_postings = self.text_index.lookup(search_value, field_name)
+                if not field_postings:
+                    return {}
+                postings.extend(field_postings)
+        if postings:
+            # начинаем с самого селективного списка и сужаем пересечением
+            postings.sort(key=len)
+            candidates = sorted(intersect(postings))
+        else:
+            candidates = self.order
         result = {}
-        for contact_id, contact in self.contacts.items():
-            if contact.multiple_search(**search_items):
-                result[contact_id] = contact
+        for contact_id in candidates:
+            if self._peek(contact_id).multiple_search(**search_items):
+                result[contact_id] = self[contact_id]
         return result
 
+    def _scan(self, index, match):  # перебор, пока индексы строятся: id с подходящим ключом
+        return {
+            contact_id
+            for contact_id in self.order
+            if any(match(key) for key in index.contact_keys(self._peek(contact_id)))
+        }
+
+    def phone_search(self, prefix="", operator=None):  # поиск по префиксу номера/оператору
+        digits = phone_digits(prefix)
+        with self.lock.reading():
+            if not self._index_ready():
+                candidates = self._scan(
+                    self.phone_index,
+                    lambda key: "".join(key).startswith(digits) and operator in (None, key[1]),
+                )
+            elif operator is not None and not prefix:
+                candidates = self.phone_index.operator(operator)
+            else:
+                candidates = self.phone_index.prefix(digits, operator)
+            return {contact_id: self[contact_id] for contact_id in sorted(candidates)}
+
+    def phone_lookup(self, number):  # точный поиск номера
+        digits = PhoneField(number).value[1:]
+        with self.lock.reading():
+            if self._index_ready():
+                candidates = self.phone_index.exact(digits)
+            else:
+                candidates = self._scan(self.phone_index, lambda key: "".join(key) == digits)
+            return {contact_id: self[contact_id] for contact_id in sorted(candidates)}
+
+    def upcoming_birthdays(self, days, today=None):  # дни рождения в ближайшие days дней
+        days = birthday_days(days)
+        if today is None:
+            today = date.today()
+        with self.lock.reading():
+            if self._index_ready():
+                birthdays = self.birthday_index.upcoming(today, days)
+            else:
+                window = [
+                    (*key, contact_id)
+                    for contact_id in self.order
+                    for key in self.birthday_index.contact_keys(self._peek(contact_id))
+                ]
+                birthdays = upcoming_dates(window, today, days)
+            return [
+                (birthday, contact_id, self[contact_id]) for birthday, contact_id in birthdays
+            ]
+
     def clear(self):    #очистить
-        self.contacts.clear()
-        self.last_contact_id = 0
+        with self.lock:
+            self._writable()
+            self.generation += 1
+            for contact in self.contacts.values():
+                if contact.book is self:
+                    contact.book = None
+            self.contacts = {}  # снимки сохраняют прежний словарь
+            self.shared = False
+            self.pending = {}
+            self.source = None
+            self.order = []
+            self.uids = {}
+            self.uid_index = {}
+            self.hashes = {}
+            self.versions = {}
+            self.era = self.generation
+            self.last_contact_id = 0
+            for index in self.indexes:
+                index.clear()
+            self.indexed = True
+            self.indexer = None  # построение для прежнего содержимого не установится
+            self.dirty = set()
+            self._log({"op": "clear"})
+
+
+class PublishedBook:
+    # AB - ссылка на текущую версию книги. /clear и /load собирают новую
+    # версию в стороне и публикуют её одной заменой ссылки, поэтому запросы
+    # не ждут их и не видят полуочищенной или полузагруженной книги. Запрос
+    # берёт версию один раз (current_book) и дальше работает с ней напрямую:
+    # чтения - под замком чтения версии, правки - на месте под её замком
+    # записи. Без замков публикуются только замены целиком: правки отдельных
+    # контактов новых версий не создают, и замок чтения, отдающий первенство
+    # писателю, задерживает чтения, пока правка ждёт. Заменённая версия
+    # правок не принимает (BookRetired), их повторяет on_current_version
+    def __init__(self, book, storage=None):
+        self.current = book
+        self.storage = storage
+        self.publish_lock = threading.Lock()  # замены идут по одной
+
+    def version(self):  # версия текущего запроса, вне запроса - последняя
+        if not has_request_context():
+            return self.current
+        if "book" not in g:
+            g.book = self.current
+        return g.book
+
+    def blank(self):
+        return self.current.blank()
+
+    def wait_indexed(self):
+        self.current.wait_indexed()
+
+    def pause_indexing(self):
+        self.current.pause_indexing()
+
+    def swap(self, replacement):  # опубликовать версию, собранную в стороне
+        with self.publish_lock:
+            retired = self.current
+            if self.storage is not None:
+                self.storage.replace(retired, replacement)
+            else:
+                retired.retire()
+            self.current = replacement
+            if self.storage is not None:  # удалять старые снимки - когда замена уже видна
+                self.storage.compact()
+        retired.detach()  # вне publish_lock: следующая замена не ждёт обхода контактов
+        if has_request_context():  # запрос, сделавший замену, видит её
+            g.book = replacement
+
+    def clear(self):
+        self.swap(self.current.blank())
+
+    def load(self, stream, lazy=False):  # при ошибке в файле книга не меняется
+        replacement = self.current.blank()
+        report = replacement.load(stream, lazy)
+        self.swap(replacement)
+        return report
+
+    def load_ndjson(self, stream, workers=None):
+        replacement = self.current.blank()
+        replacement.load_ndjson(stream, workers)
+        self.swap(replacement)
+
+
+class ContactView(Mapping):
+    # результат поиска в SQLiteAddressBook: id сразу, контакты - при обращении
+    def __init__(self, book, ids):
+        self.book = book
+        self.ids = ids
+        self.id_set = set(ids)
+
+    def __getitem__(self, contact_id):
+        if contact_id not in self.id_set:
+            raise KeyError(contact_id)
+        return self.book[contact_id]
 
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def field_key(field):  # ключ для индексированных запросов по телефону и дню рождения
+    if isinstance(field, PhoneField):
+        return field.value[1:]
+    if isinstance(field, BirthdayField):
+        return datetime.strptime(field.value, "%d.%m.%Y").strftime("%m%d")
+    return None
+
+
+class SQLiteAddressBook:
+    # Та же книга, но в файле SQLite: поля в таблице fields с индексами
+    # по типу поля, поиск подстроки - через FTS5 с триграммным токенизатором
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS contacts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid TEXT,
+            hash BLOB
+        );
+        CREATE TABLE IF NOT EXISTS fields (
+            id INTEGER PRIMARY KEY,
+            contact_id INTEGER NOT NULL REFERENCES contacts (id),
+            position INTEGER NOT NULL,
+            field_name TEXT NOT NULL,
+            value TEXT NOT NULL,
+            key TEXT,
+            UNIQUE (contact_id, position)
+        );
+        CREATE INDEX IF NOT EXISTS fields_by_type ON fields (field_name, key);
+        CREATE INDEX IF NOT EXISTS fields_by_contact
+            ON fields (contact_id, field_name, position);
+        CREATE INDEX IF NOT EXISTS phones_by_operator
+            ON fields (substr(key, 3, 3)) WHERE field_name = 'Phone';
+        CREATE VIRTUAL TABLE IF NOT EXISTS fields_fts USING fts5 (
+            value,
+            content = 'fields',
+            content_rowid = 'id',
+            tokenize = 'trigram case_sensitive 1'
+        );
+        CREATE TRIGGER IF NOT EXISTS fields_insert AFTER INSERT ON fields BEGIN
+            INSERT INTO fields_fts (rowid, value) VALUES (new.id, new.value);
+        END;
+        CREATE TRIGGER IF NOT EXISTS fields_delete AFTER DELETE ON fields BEGIN
+            INSERT INTO fields_fts (fields_fts, rowid, value)
+                VALUES ('delete', old.id, old.value);
+        END;
+    """
+    # поле - первое поле своего типа у контакта, как в Contact.field_search
+    FIRST_FIELD = """
+        f.position = (
+            SELECT min(position) FROM fields
+            WHERE contact_id = f.contact_id AND field_name = f.field_name
+        )
+    """
+
+    LOADED = 1  # PRAGMA user_version: книга уже загружалась, пустая - значит очищена
+    BUSY_TIMEOUT = 300  # секунд: запись ждёт, пока другое соединение заменяет книгу
+
+    def __init__(self, path, cache_size=256):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(self.SCHEMA)
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(contacts)")}
+        if "uid" not in columns:  # база прежней версии, без внешних id
+            self.db.execute("ALTER TABLE contacts ADD COLUMN uid TEXT")
+            self.db.execute("ALTER TABLE contacts ADD COLUMN hash BLOB")
+        self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS contacts_by_uid ON contacts (uid)")
+        # новая база: файл мог остаться от запуска, упавшего до первой загрузки
+        self.created = (
+            self.db.execute("PRAGMA user_version").fetchone()[0] < self.LOADED
+            and self.db.execute("SELECT 1 FROM contacts LIMIT 1").fetchone() is None
+        )
+        self.lock = threading.RLock()
+        self.swap_lock = threading.Lock()  # записи этого процесса ждут замены книги на нём
+        self.changes = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self.search_cache = SearchCache(cache_size)
+
+    def reopen(self):  # соединение не переживает fork: у рабочего процесса своё
+        self.db = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.swap_lock = threading.Lock()
+        # changes считается в своём соединении, ETag разных процессов не должны совпасть
+        self.changes = 0
+        self.epoch = uuid.uuid4().hex[:8]
+
+    @property
+    def generation(self):  # data_version меняется при записи из других соединений
+        with self.lock:
+            data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            return self.changes, data_version
+
+    @contextmanager
+    def _writing(self):  # транзакция записи; идущую замену книги ждёт, не занимая self.lock
+        with self.swap_lock, self.lock, self.db:
+            yield
+
+    def _query_ids(self, sql, *params):
+        with self.lock:
+            return [row[0] for row in self.db.execute(sql, params)]
+
+    def _load_contacts(self, contact_ids):
+        contacts = {contact_id: Contact() for contact_id in contact_ids}
+        placeholders = ", ".join("?" * len(contacts))
+        with self.lock:
+            found = self._query_ids(
+                f"SELECT id FROM contacts WHERE id IN ({placeholders})", *contacts
+            )
+            rows = self.db.execute(
+                f"SELECT contact_id, field_name, value FROM fields "
+                f"WHERE contact_id IN ({placeholders}) ORDER BY contact_id, position",
+                tuple(contacts),
+            ).fetchall()
+        for contact_id, field_name, value in rows:
+            contacts[contact_id].add(
+                field_decoder({"field_name": field_name, "value": value})
+            )
+        result = {}
+        for contact_id in sorted(found):
+            contact = contacts[contact_id]
+            contact.book = self
+            contact.contact_id = contact_id
+            result[contact_id] = contact
+        return result
+
+    def __getitem__(self, key):
+        key = self.resolve(key)
+        contacts = self._load_contacts([key])
+        if key not in contacts:
+            raise KeyError(key)
+        return contacts[key]
+
+    def resolve(self, key):
+        if isinstance(key, int):
+            return key
+        found = self._query_ids("SELECT id FROM contacts WHERE uid = ?", key)
+        if found:
+            return found[0]
+        try:
+            return int(key)
+        except ValueError:
+            raise KeyError(key) from None
+
+    def etag(self):
+        changes, data_version = self.generation
+        return f"{self.epoch}-{changes}-{data_version}"
+
+    def contact_etag(self, key):
+        # хеш содержимого с uid не зависят от процесса и перезапуска - epoch не нужен
+        contact_id = self.resolve(key)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hash, coalesce(uid, id) FROM contacts WHERE id = ?", (contact_id,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(key)
+            digest, uid = row
+            if digest is None:  # строки из базы прежней версии
+                digest = content_hash(self._contact_json(contact_id))
+        return f"{uid_tag(str(uid))}-{digest.hex()}"
+
+    def uid(self, contact_id):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT uid FROM contacts WHERE id = ?", (contact_id,)
+            ).fetchone()
+        return row[0] if row and row[0] is not None else str(contact_id)
+
+    def _write_fields(self, contact_id, contact, digest=None):
+        # hash - хэш содержимого контакта, он же его ETag
+        if digest is None:
+            digest = content_hash(contact.to_json())
+        self.db.execute("UPDATE contacts SET hash = ? WHERE id = ?", (digest, contact_id))
+        self.db.execute("DELETE FROM fields WHERE contact_id = ?", (contact_id,))
+        self.db.executemany(
+            "INSERT INTO fields (contact_id, position, field_name, value, key) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [
+                (contact_id, position, field.field_description, field.value, field_key(field))
+                for position, field in enumerate(contact.fields)
+            ],
+        )
+
+    def _insert(self, contact, uid=None, digest=None):
+        if uid is None:
+            uid = str(uuid.uuid4())
+        else:  # повтор ключа: запись принадлежит последнему контакту
+            self.db.execute("UPDATE contacts SET uid = NULL WHERE uid = ?", (uid,))
+        contact_id = self.db.execute(
+            "INSERT INTO contacts (uid) VALUES (?)", (uid,)
+        ).lastrowid
+        self._write_fields(contact_id, contact, digest)
+        contact.book = self
+        contact.contact_id = contact_id
+        return contact_id
+
+    def _contact_json(self, contact_id):
+        rows = self.db.execute(
+            "SELECT field_name, value FROM fields WHERE contact_id = ? ORDER BY position",
+            (contact_id,),
+        )
+        return {
+            "fields": [
+                {"value": value, "field_name": field_name} for field_name, value in rows
+            ]
+        }
+
+    def contact_changing(self, contact):  # выгрузка читает отдельным соединением
+        pass
+
+    def contact_changed(self, contact, record):
+        # self.lock уже взят Contact._locked: swap_lock после него - обратный порядок
+        with self.lock, self.db:
+            self._write_fields(contact.contact_id, contact)
+            self.changes += 1
+
+    def dumps(self):
+        return "".join(self.iter_dump())
+
+    def iter_dump(self):
+        return iter_json_object(self._iter_json())
+
+    def iter_ndjson(self):
+        return iter_ndjson(self._iter_json())
+
+    def _iter_json(self):  # читаем через отдельное соединение - согласованный снимок
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute(
+                "SELECT c.id, coalesce(c.uid, c.id), f.field_name, f.value FROM contacts c "
+                "LEFT JOIN fields f ON f.contact_id = c.id ORDER BY c.id, f.position"
+            )
+            for (_, uid), group in groupby(rows, key=lambda row: row[:2]):
+                yield str(uid), {
+                    "fields": [
+                        {"value": value, "field_name": field_name}
+                        for _, _, field_name, value in group
+                        if field_name is not None
+                    ]
+                }
+        finally:
+            db.close()
+
+    def loads(self, bytes_contacts):
+        if isinstance(bytes_contacts, str):
+            self.load(io.StringIO(bytes_contacts))
+        else:
+            self.load(io.BytesIO(bytes_contacts))
+
+    def load(self, stream, lazy=False):  # одна транзакция; lazy не нужен - строки в базе
+        with self._writing():
+            self._clear(self.db)
+            for uid, contact_list in JSONObjectReader(stream):
+                self._insert(contact_from_json(contact_list), uid)
+            self.changes += 1
+
+    def load_ndjson(self, stream, workers=None):
+        with self._writing():
+            self._clear(self.db)
+            for uid, contact in ndjson_contacts(stream, workers):
+                self._insert(contact, uid)
+            self.changes += 1
+
+    def version(self):  # одна книга на все запросы, замена идёт транзакцией
+        return self
+
+    def wait_indexed(self):  # индексы ведёт SQLite
+        pass
+
+    def pause_indexing(self):
+        pass
+
+    def blank(self):  # у каждой замены свой файл рядом с базой: задания не мешают друг другу
+        descriptor, path = tempfile.mkstemp(
+            prefix=os.path.basename(self.path) + ".replacement-",
+            dir=os.path.dirname(os.path.abspath(self.path)),
+        )
+        os.close(descriptor)
+        return SQLiteAddressBook(path, self.search_cache.maxsize)
+
+    def discard(self):  # удалить файл замены: после переноса строк или при ошибке
+        self.db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def swap(self, replacement):  # перенести строки replacement одной транзакцией
+        # Копирует отдельное соединение: в режиме WAL чтения через self.db идут
+        # всё это время и видят прежнюю книгу до COMMIT, self.lock не занят
+        replacement.db.close()
+        with self.swap_lock:
+            db = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT)
+            try:
+                db.execute("ATTACH DATABASE ? AS replacement", (replacement.path,))
+                with db:
+                    self._clear(db)
+                    db.execute(
+                        "INSERT INTO contacts (id, uid, hash) "
+                        "SELECT id, uid, hash FROM replacement.contacts"
+                    )
+                    db.execute(
+                        "INSERT INTO fields (id, contact_id, position, field_name, value, key) "
+                        "SELECT id, contact_id, position, field_name, value, key "
+                        "FROM replacement.fields"
+                    )
+            finally:
+                db.close()
+        with self.lock:
+            self.changes += 1
+        replacement.discard()
+
+    def import_contacts(self, entries):
+        count = 0
+        with self._writing():
+            for uid, contact in entries:
+                row = self.db.execute(
+                    "SELECT id FROM contacts WHERE uid = ?", (uid,)
+                ).fetchone()
+                if row is None:
+                    self._insert(contact, uid)
+                else:
+                    self._write_fields(row[0], contact)
+                count += 1
+            self.changes += 1
+        return count
+
+    def merge(self, stream, prune=False):  # одна транзакция, как load
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        seen = set()
+        with self._writing():
+            for uid, contact_list in JSONObjectReader(stream):
+                if prune:
+                    seen.add(uid)
+                digest = content_hash(contact_list)
+                row = self.db.execute(
+                    "SELECT id, hash FROM contacts WHERE uid = ?", (uid,)
+                ).fetchone()
+                if row is None:
+                    self._insert(contact_from_json(contact_list), uid, digest)
+                    stats["added"] += 1
+                    continue
+                contact_id, stored = row
+                if digest == stored or digest == content_hash(self._contact_json(contact_id)):
+                    stats["unchanged"] += 1
+                else:
+                    self._write_fields(contact_id, contact_from_json(contact_list), digest)
+                    stats["updated"] += 1
+                    continue
+                self.db.execute(
+                    "UPDATE contacts SET hash = ? WHERE id = ?", (digest, contact_id)
+                )
+            if prune:
+                stale = [
+                    contact_id
+                    for contact_id, uid in self.db.execute("SELECT id, uid FROM contacts")
+                    if uid not in seen
+                ]
+                for contact_id in stale:
+                    self._delete(contact_id)
+                stats["deleted"] = len(stale)
+            self.changes += 1
+        return stats
+
+    def add(self, contact):
+        with self._writing():
+            contact_id = self._insert(contact)
+            self.changes += 1
+            return contact_id
+
+    def replace(self, contact_id, contact):
+        with self._writing():
+            contact_id = self.resolve(contact_id)
+            if not self._query_ids("SELECT id FROM contacts WHERE id = ?", contact_id):
+                raise KeyError(f"contact {contact_id} not found")
+            self._write_fields(contact_id, contact)
+            contact.book = self
+            contact.contact_id = contact_id
+            self.changes += 1
+
+    @index_error_decorator
+    def delete(self, contact_id):
+        with self._writing():
+            key = self.resolve(contact_id)
+            if not self._delete(key):
+                raise KeyError(key)
+            self.changes += 1
+
+    def _delete(self, contact_id):
+        self.db.execute("DELETE FROM fields WHERE contact_id = ?", (contact_id,))
+        return self.db.execute("DELETE FROM contacts WHERE id = ?", (contact_id,)).rowcount
+
+    def _clear(self, db):
+        db.execute("DELETE FROM fields")
+        db.execute("DELETE FROM contacts")
+        db.execute("DELETE FROM sqlite_sequence WHERE name = 'contacts'")
+        db.execute(f"PRAGMA user_version = {self.LOADED}")  # в той же транзакции
+
+    def clear(self):
+        with self._writing():
+            self._clear(self.db)
+            self.changes += 1
+
+    def page(self, limit, after=None, before=None, ids=None):
+        if ids is not None:
+            page_ids, prev_id, next_id = keyset_page(ids, limit, after, before)
+            return self._load_contacts(page_ids), prev_id, next_id
+        if before is not None:
+            page_ids = self._query_ids(
+                "SELECT id FROM contacts WHERE id < ? ORDER BY id DESC LIMIT ?",
+                before,
+                limit + 1,
+            )[::-1]
+            has_prev, has_next = len(page_ids) > limit, True
+            page_ids = page_ids[-limit:]
+        else:
+            page_ids = self._query_ids(
+                "SELECT id FROM contacts WHERE id > ? ORDER BY id LIMIT ?",
+                -1 if after is None else after,
+                limit + 1,
+            )
+            has_prev, has_next = after is not None, len(page_ids) > limit
+            page_ids = page_ids[:limit]
+        prev_id = page_ids[0] if page_ids and has_prev else None
+        next_id = page_ids[-1] if page_ids and has_next else None
+        return self._load_contacts(page_ids), prev_id, next_id
+
+    def _cached_search(self, key, search, *args, **kwargs):
+        result = self.search_cache.get(key, self.generation)
+        if result is None:
+            generation = self.generation
+            result = ContactView(self, search(*args, **kwargs))
+            self.search_cache.put(key, generation, result)
+        return result
+
+    def str_search(self, search_str: str):
+        return self._cached_search(("all", search_str), self._str_search, search_str)
+
+    def multiple_search(self, **search_items):
+        key = ("fields", tuple(sorted(search_items.items())))
+        return self._cached_search(key, self._multiple_search, **search_items)
+
+    @staticmethod
+    def _match(search_str):  # фраза FTS5: триграммы ищут подстроку от 3 символов
+        return '"' + search_str.replace('"', '""') + '"'
+
+    def _str_search(self, search_str):
+        if len(search_str) < 3:
+            return self._query_ids(
+                "SELECT DISTINCT contact_id FROM fields WHERE instr(value, ?) > 0 "
+                "ORDER BY contact_id",
+                search_str,
+            )
+        return self._query_ids(
+            "SELECT DISTINCT f.contact_id FROM fields_fts "
+            "JOIN fields f ON f.id = fields_fts.rowid "
+            "WHERE fields_fts MATCH ? AND instr(f.value, ?) > 0 ORDER BY f.contact_id",
+            self._match(search_str),
+            search_str,
+        )
+
+    def _multiple_search(self, **search_items):
+        if not search_items:
+            return self._query_ids("SELECT id FROM contacts ORDER BY id")
+        queries = []
+        params = []
+        for field_name, search_value in search_items.items():
+            sql = (
+                "SELECT DISTINCT f.contact_id FROM fields f WHERE f.field_name = ? "
+                f"AND instr(f.value, ?) > 0 AND {self.FIRST_FIELD}"
+            )
+            params += [field_name, search_value]
+            if len(search_value) >= 3:
+                sql += " AND f.id IN (SELECT rowid FROM fields_fts WHERE fields_fts MATCH ?)"
+                params.append(self._match(search_value))
+            queries.append(sql)
+        return self._query_ids(" INTERSECT ".join(queries) + " ORDER BY 1", *params)
+
+    def phone_search(self, prefix="", operator=None):
+        # префикс и оператор - условия на один и тот же номер
+        conditions = ["field_name = 'Phone'"]
+        params = []
+        if operator is None or prefix:
+            digits = phone_digits(prefix)
+            conditions.append("key >= ? AND key < ?")
+            params += [digits, digits + ":"]  # ":" идёт сразу после "9"
+        if operator is not None:
+            conditions.append("substr(key, 3, 3) = ?")
+            params.append(operator)
+        ids = self._query_ids(
+            "SELECT DISTINCT contact_id FROM fields WHERE "
+            + " AND ".join(conditions)
+            + " ORDER BY contact_id",
+            *params,
+        )
+        return ContactView(self, ids)
+
+    def phone_lookup(self, number):
+        digits = PhoneField(number).value[1:]
+        ids = self._query_ids(
+            "SELECT DISTINCT contact_id FROM fields "
+            "WHERE field_name = 'Phone' AND key = ? ORDER BY contact_id",
+            digits,
+        )
+        return ContactView(self, ids)
+
+    def upcoming_birthdays(self, days, today=None):
+        days = birthday_days(days)
+        if today is None:
+            today = date.today()
+        sql = (
+            "SELECT f.key, f.contact_id FROM fields f "
+            f"WHERE f.field_name = 'Birthday' AND {self.FIRST_FIELD}"
+        )
+        windows = birthday_windows(today, days)
+        if windows is None:
+            rows = self._query_rows(sql)
+        else:
+            rows = []
+            for first, last in windows:
+                rows += self._query_rows(
+                    sql + " AND f.key BETWEEN ? AND ?",
+                    "%02d%02d" % first,
+                    "%02d%02d" % last,
+                )
+        window = [(int(key[:2]), int(key[2:]), contact_id) for key, contact_id in rows]
+        birthdays = upcoming_dates(window, today, days)
+        contacts = self._load_contacts([contact_id for _, contact_id in birthdays])
+        return [
+            (birthday, contact_id, contacts[contact_id])
+            for birthday, contact_id in birthdays
+        ]
+
+    def _query_rows(self, sql, *params):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+
+class GCStats:
+    # Сборки мусора в этом процессе: gc.callbacks отмечает начало и конец
+    # каждой сборки, последние MAX_PAUSES пауз поколения хранятся для перцентилей
+    MAX_PAUSES = 10000
+
+    def __init__(self):
+        self.started = None
+        self.reset()
+
+    def reset(self):  # рабочий процесс считает свои сборки, без родительских
+        self.collections = [0, 0, 0]
+        self.collected = [0, 0, 0]
+        self.pauses = [deque(maxlen=self.MAX_PAUSES) for _ in range(3)]
+
+    def __call__(self, phase, info):
+        if phase == "start":
+            self.started = time.perf_counter()
+            return
+        generation = info["generation"]
+        self.pauses[generation].append(time.perf_counter() - self.started)
+        self.collections[generation] += 1
+        self.collected[generation] += info["collected"]
+
+    def stats(self):
+        generations = []
+        for generation, pauses in enumerate(self.pauses):
+            pauses = sorted(pauses)
+            generations.append(
+                {
+                    "collections": self.collections[generation],
+                    "collected": self.collected[generation],
+                    "pause_p50_ms": percentile_ms(pauses, 0.5),
+                    "pause_p99_ms": percentile_ms(pauses, 0.99),
+                    "pause_max_ms": percentile_ms(pauses, 1),
+                    "pause_total_ms": round(sum(pauses) * 1000, 3),
+                }
+            )
+        return {
+            "frozen": gc.get_freeze_count(),
+            "counts": gc.get_count(),
+            "thresholds": gc.get_threshold(),
+            "generations": generations,
+        }
+
+
+def percentile_ms(values, fraction):  # values отсортированы, в секундах
+    if not values:
+        return None
+    return round(values[min(int(len(values) * fraction), len(values) - 1)] * 1000, 3)
+
+
+def memory_usage():  # kB из /proc: Shared_* - страницы, ещё общие с родителем после fork
+    try:
+        with open("/proc/self/smaps_rollup") as file:
+            lines = file.readlines()
+    except OSError:  # не Linux
+        return None
+    usage = {}
+    for line in lines[1:]:
+        name, value = line.split(":", 1)
+        if name in ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty"):
+            usage[name.lower()] = int(value.split()[0])
+    return usage
+
+
+def freeze_heap():
+    # загруженная книга - в постоянное поколение: сборщик её больше не обходит,
+    # не пишет в заголовки объектов и не копирует страницы рабочих процессов.
+    # Куча не размораживается: заменённые версии книги освобождает подсчёт
+    # ссылок (AddressBook.detach)
+    gc.collect()
+    gc.freeze()
+
+
+def index_and_freeze(book):  # в рабочем процессе, в своём потоке
+    book.wait_indexed()
+    if app.config["GC_FREEZE"]:  # загруженная книга заморожена в родителе, теперь - индексы
+        freeze_heap()
+
+
+GC_STATS = GCStats()
+gc.callbacks.append(GC_STATS)
 
 app = Flask("answer")
-AB = AddressBook()
+app.config.update(
+    PAGE_SIZE=50,
+    MAX_PAGE_SIZE=500,
+    DATA_DIR="data",  # снимки и журнал изменений; None - только ab.json
+    JOURNAL_FSYNC=False,
+    CHECKPOINT_INTERVAL=60,  # секунд между снимками; 0 - без фоновых снимков
+    LAZY_LOAD=False,  # собирать контакты из JSON при первом обращении
+    STORAGE_ENGINE="memory",  # "memory" или "sqlite"
+    SQLITE_PATH="ab.sqlite3",
+    IMPORT_WORKERS=None,  # процессов для разбора NDJSON, CSV и vCard; None - по числу ядер
+    THREADED=True,  # обрабатывать запросы в потоках; книга защищена замком чтения-записи
+    # рабочих процессов; больше одного - только с sqlite: книгу в памяти
+    # процессы не делят, каждый правил бы свою копию (см. PreforkServer)
+    SERVER_WORKERS=1,
+    SERVER_THREADS=8,  # потоков на рабочий процесс
+    SERVER_MAX_REQUESTS=0,  # после стольких запросов рабочий сменяется; 0 - никогда
+    SERVER_GRACEFUL_TIMEOUT=30,  # секунд на завершение начатых запросов при остановке
+    GC_FREEZE=True,  # перед запуском рабочих процессов - gc.freeze(), см. freeze_heap
+)
+app.config.from_envvar("AB_SETTINGS", silent=True)
+
+# книга открывается в create_app, а не при импорте: процессы пула импорта
+# (spawn, forkserver) импортируют модуль заново и не должны загружать книгу
+AB = None
+STORAGE = None
+CHECKPOINTER = None
+
+
+def open_book():
+    global AB, STORAGE, CHECKPOINTER
+    if app.config["STORAGE_ENGINE"] == "sqlite":
+        AB = SQLiteAddressBook(app.config["SQLITE_PATH"])
+        if AB.created:
+            with open("ab.json", "rb") as file:
+                AB.load(file)
+    elif app.config["DATA_DIR"]:
+        STORAGE = BookStorage(app.config["DATA_DIR"], app.config["JOURNAL_FSYNC"])
+        AB = PublishedBook(AddressBook(), STORAGE)
+        STORAGE.open(AB.current, "ab.json", app.config["LAZY_LOAD"])
+        if app.config["CHECKPOINT_INTERVAL"]:
+            CHECKPOINTER = Checkpointer(AB, STORAGE, app.config["CHECKPOINT_INTERVAL"])
+            CHECKPOINTER.start()
+    else:
+        AB = PublishedBook(AddressBook())
+        with open("ab.json", "rb") as file:
+            AB.load(file, app.config["LAZY_LOAD"])
+
+
+def create_app():  # для WSGI-сервера и тестов: answer:create_app()
+    if AB is None:
+        open_book()
+    return app
+
 
-with open("ab.json") as file:
-    AB.loads(file.read())
+def current_book():  # версия книги, с которой работает запрос
+    return AB.version()
+
+
+def on_current_version(view):
+    # правка, которую отвергла заменённая версия книги (BookRetired),
+    # повторяется в текущей; удавшаяся правка не повторяется никогда
+    @wraps(view)
+    def inner(*args, **kwargs):
+        while True:
+            try:
+                return view(*args, **kwargs)
+            except BookRetired:
+                g.pop("book", None)
+
+    return inner
+
+
+@app.context_processor
+def contact_links():  # ссылки на контакты строятся по UUID, он не меняется при загрузке
+    return {"contact_uid": current_book().uid}
 
 
 @app.errorhandler(KeyError)
@@ -316,18 +3118,72 @@ def handle_invalid_format(error):
     return render_template("error.jinja", message=str(error))
 
 
-@app.route("/")
-def ab():
+@app.errorhandler(BookRetired)  # слияние или импорт, прерванные заменой книги
+def handle_book_retired(error):
+    return render_template("error.jinja", message=str(error)), 409
+
+
+def render_contacts_page(endpoint, ids=None, **query):
+    limit = request.args.get("limit", app.config["PAGE_SIZE"], type=int)
+    limit = max(1, min(limit, app.config["MAX_PAGE_SIZE"]))
+    contacts, prev_id, next_id = current_book().page(
+        limit,
+        after=request.args.get("after", type=int),
+        before=request.args.get("before", type=int),
+        ids=ids,
+    )
+    prev_url = next_url = None
+    if prev_id is not None:
+        prev_url = url_for(endpoint, before=prev_id, limit=limit, **query)
+    if next_id is not None:
+        next_url = url_for(endpoint, after=next_id, limit=limit, **query)
     return render_template(
-        "contacts.jinja", contacts=AB.contacts, stat_url=''
+        "contacts.jinja",
+        contacts=contacts,
+        stat_url='',
+        prev_url=prev_url,
+        next_url=next_url,
     )
 
 
+@app.route("/")
+def ab():
+    return render_contacts_page("ab")
+
+
+def not_modified(etag):  # 304 без выгрузки и шаблона, если версия у клиента та же
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
 
 @app.route("/dump")
 def ab_dump():
-    fh = io.BytesIO(AB.dumps().encode())
-    return send_file(fh, attachment_filename="AB.json")
+    dump_format = request.args.get("format")
+    gzipped = dump_format not in DUMP_FORMATS and bool(request.accept_encodings["gzip"])
+    # у каждого представления выгрузки свой ETag
+    book = current_book()
+    etag = f"{book.etag()}-{dump_format or 'json'}{'-gzip' if gzipped else ''}"
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    if dump_format in DUMP_FORMATS:  # сжатый файл для скачивания
+        compressor, mimetype = DUMP_FORMATS[dump_format]
+        response = Response(
+            compressed(chunked(book.iter_dump()), compressor()), mimetype=mimetype
+        )
+    elif dump_format == "ndjson":
+        response = Response(chunked(book.iter_ndjson()), mimetype="application/x-ndjson")
+    else:
+        response = Response(chunked(book.iter_dump()), mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if gzipped:
+        response.response = compressed(response.response, DUMP_FORMATS["gzip"][0]())
+        response.content_encoding = "gzip"
+    response.set_etag(etag)
+    return response
 
 
 @app.route("/clear")
@@ -346,47 +3202,171 @@ def ab_load():
         if file.filename == "":
             flash("No selected file")
             return redirect(request.url)
-        AB.loads(file.stream.read())
+        ndjson = request.form.get("format") == "ndjson" or file.filename.endswith(
+            (".ndjson", ".jsonl")
+        )
+        background = request.values.get("async") and request.form.get("mode") != "merge"
+        if background:  # файл сохраняется, ответ - id задания для /load/<job_id>
+            descriptor, path = tempfile.mkstemp(prefix="ab-load-")
+            with os.fdopen(descriptor, "wb") as saved:
+                shutil.copyfileobj(file.stream, saved)
+            job = LoadJob(AB, path, ndjson, app.config["IMPORT_WORKERS"])
+            job.start()
+            response = jsonify(job.progress())
+            response.status_code = 202
+            response.headers["Location"] = url_for("load_job", job_id=job.job_id)
+            return response
+        stream = decompressing(file.stream)
+        if ndjson:
+            if request.form.get("mode") == "merge":
+                raise IncorrectInput("Merge by id needs a JSON file")
+            AB.load_ndjson(stream, app.config["IMPORT_WORKERS"])
+        elif request.form.get("mode") == "merge":  # обновить книгу по внешним id
+            stats = current_book().merge(stream, prune="prune" in request.form)
+            if request.args.get("format") == "json":
+                return jsonify(stats)
+        else:
+            report = AB.load(stream, app.config["LAZY_LOAD"])  # ленивая загрузка - с отчётом
+            if report is not None and request.args.get("format") == "json":
+                return jsonify(report)
         return redirect(url_for("ab"))
     return render_template("load.jinja")
 
 
+@app.route("/load/<job_id>")
+def load_job(job_id):
+    job = LoadJob.find(job_id)
+    if job is None:  # клиент опрашивает JSON - и ошибка в JSON, а не страница
+        response = jsonify(job_id=job_id, error="Load job not found")
+        response.status_code = 404
+        return response
+    return jsonify(job.progress())
+
+
+@app.route("/import", methods=("GET", "POST"))
+def bulk_import():  # CSV или vCard: контакты добавляются к книге, ошибки - в отчёт
+    if request.method == "POST":
+        if "file" not in request.files:
+            flash("No file part")
+            return redirect(request.url)
+        file = request.files["file"]
+        if file.filename == "":
+            flash("No selected file")
+            return redirect(request.url)
+        stream = decompressing(file.stream)
+        if request.form.get("format") == "vcard" or file.filename.lower().endswith(
+            (".vcf", ".vcard")
+        ):
+            parse, records = vcard_record, vcard_cards(stream)
+        else:
+            parse, records = csv_record, csv_rows(stream)
+        report = {"imported": 0, "error_count": 0, "errors": []}
+        report["imported"] = current_book().import_contacts(
+            import_records(parse, records, report, app.config["IMPORT_WORKERS"])
+        )
+        return jsonify(report)
+    return render_template("import.jinja")
+
+
 @app.route("/search", methods=("GET", "POST"))
 def search():
-    if request.method == "GET":
+    # GET с параметрами запроса - следующие страницы результатов поиска
+    params = request.form if request.method == "POST" else request.args
+    if "value" not in params:
         return render_template("search.jinja", fields=REGISTERED_FIELDS.keys())
 
-    if request.form["value"] != "":
-        #stat_url = url_for("search_stat", all=request.form["value"])
-        search_result = AB.str_search(request.form["value"])
+    fields = params.getlist("field")
+    values = params.getlist("value")
+    if params["value"] != "":
+        #stat_url = url_for("search_stat", all=params["value"])
+        search_result = current_book().str_search(params["value"])
     else:
-        fields = [field for field in request.form.to_dict(flat=False)["field"]]
-        values = [value for value in request.form.to_dict(flat=False)["value"]]
         search_query = {
             field: value for field, value in filter(lambda x: x[1], zip(fields, values))
         }
-        print(search_query)
         #stat_url = url_for("search_stat", **search_query)
-        search_result = AB.multiple_search(**search_query)
+        search_result = current_book().multiple_search(**search_query)
+    return render_contacts_page(
+        "search", ids=list(search_result), field=fields, value=values
+    )
+
+
+@app.route("/search/cache")
+def search_cache_stats():
+    return jsonify(current_book().search_cache.stats())
+
+
+@app.route("/gc")
+def gc_stats():  # у каждого рабочего процесса свои, отсюда pid
+    return jsonify(pid=os.getpid(), memory=memory_usage(), **GC_STATS.stats())
+
+
+@app.route("/phones")
+def phone_search():
+    book = current_book()
+    if "number" in request.args:
+        search_result = book.phone_lookup(request.args["number"])
+    else:
+        search_result = book.phone_search(
+            request.args.get("prefix", ""), request.args.get("operator")
+        )
+    if request.args.get("format") == "json":
+        return jsonify(
+            {
+                book.uid(contact_id): contact.to_json()
+                for contact_id, contact in search_result.items()
+            }
+        )
     return render_template("contacts.jinja", contacts=search_result, stat_url='')
 
 
+@app.route("/birthdays")
+def upcoming_birthdays():
+    days = birthday_days(request.args.get("days", 7, type=int))
+    book = current_book()
+    birthdays = book.upcoming_birthdays(days)
+    if request.args.get("format") == "json":
+        return jsonify(
+            [
+                {
+                    "id": book.uid(contact_id),
+                    "birthday": birthday.strftime("%d.%m.%Y"),
+                    "contact": contact.to_json(),
+                }
+                for birthday, contact_id, contact in birthdays
+            ]
+        )
+    contacts = {contact_id: contact for _, contact_id, contact in birthdays}
+    return render_template("contacts.jinja", contacts=contacts, stat_url='')
+
+
 @app.route("/ab/contact", methods=("GET", "POST"))
+@on_current_version
 def new_contact():
-    contact = Contact()
-    contact_id = AB.add(contact)
-    return redirect(url_for(endpoint="contact", contact_id=contact_id))
+    book = current_book()
+    contact_id = book.add(Contact())
+    return redirect(url_for(endpoint="contact", contact_id=book.uid(contact_id)))
 
 
-@app.route("/ab/contact/<int:contact_id>/delete")
+# contact_id в адресах - UUID контакта или его числовой id
+@app.route("/ab/contact/<contact_id>/delete")
+@on_current_version
 def delete_contact(contact_id):
-    AB.delete(contact_id)
+    current_book().delete(contact_id)
     return redirect(url_for(endpoint="ab", contact_id=contact_id))
 
 
-@app.route("/ab/contact/<int:contact_id>", methods=("GET", "POST"))
+@app.route("/ab/contact/<contact_id>", methods=("GET", "POST"))
+@on_current_version
 def contact(contact_id):
-    current_contact = AB[contact_id]
+    book = current_book()
+    if request.method == "GET":
+        etag = book.contact_etag(contact_id)
+        response = not_modified(etag)
+        if response is not None:
+            return response
+    current_contact = book[contact_id]
+    contact_id = book.uid(book.resolve(contact_id))
     if request.method == "POST":
         if "idx" in request.form:
             idxs = [int(idx) for idx in request.form.to_dict(flat=False)["idx"]]
@@ -399,25 +3379,260 @@ def contact(contact_id):
             field = field_class(request.form["value"])
             current_contact.add(field)
 
-    return render_template(
-        "contact.jinja",
-        contact=current_contact,
-        contact_id=contact_id,
-        fields=REGISTERED_FIELDS.keys(),
+    response = make_response(
+        render_template(
+            "contact.jinja",
+            contact=current_contact,
+            contact_id=contact_id,
+            fields=REGISTERED_FIELDS.keys(),
+        )
     )
+    if request.method == "GET":
+        response.set_etag(etag)
+    return response
 
 
-@app.route("/ab/contact/<int:contact_id>/field/<int:field_index>/delete")
+@app.route("/ab/contact/<contact_id>/field/<int:field_index>/delete")
+@on_current_version
 def delete_field(contact_id, field_index):
-    current_contact = AB[contact_id]
+    current_contact = current_book()[contact_id]
     current_contact.delete(field_index)
     return redirect(url_for("contact", contact_id=contact_id))
 
 
-def main():
-    from werkzeug.serving import run_simple
+class PooledWSGIServer(BaseWSGIServer):
+    # werkzeug-сервер на готовом сокете; запросы обслуживает пул из threads потоков
+    multithread = True
+
+    def __init__(self, host, app, threads, fd):
+        super().__init__(host, 0, app, fd=fd)
+        self.socket.setblocking(False)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="request")
+
+    def get_request(self):
+        # о соединении на общем сокете просыпаются все рабочие, принимает
+        # один; остальным accept бросает BlockingIOError, и socketserver,
+        # как на любой OSError из get_request, просто ждёт следующего
+        request, client_address = self.socket.accept()
+        request.setblocking(True)  # на BSD и macOS соединение наследует O_NONBLOCK
+        return request, client_address
 
-    run_simple("0.0.0.0", 5050, app)
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):  # как в ThreadingMixIn
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class PreforkServer:
+    # Боевой сервер: книга загружается в родителе один раз, рабочие процессы
+    # получают её через fork и принимают соединения с общего сокета.
+    # Несколько рабочих - только с sqlite: у них общая база в файле. Книгу в
+    # памяти обслуживает один рабочий (с потоками) - разделения одной книги
+    # в памяти между процессами copy-on-write нет: каждый правил бы свою
+    # копию. Индексы рабочий строит сам, после fork, и его правки страницы
+    # родителя всё равно копируют. SIGHUP - смена рабочих без закрытия сокета:
+    # соединения не теряются, но без простоя - только если журнала нет
+    # (sqlite или без DATA_DIR), тогда новые рабочие запускаются сразу.
+    # С DATA_DIR у журнала один писатель: новый рабочий стартует после ухода
+    # старого, и до того (не дольше graceful_timeout) соединения ждут в
+    # очереди сокета. SIGTERM/SIGINT - остановка после начатых запросов
+    def __init__(self, host, port, workers=1, threads=8, max_requests=0, graceful_timeout=30):
+        if workers > 1 and app.config["STORAGE_ENGINE"] != "sqlite":
+            # у каждого процесса своя копия книги в памяти, правки разойдутся
+            raise RuntimeError(
+                "In-memory book is served by one worker; "
+                "use STORAGE_ENGINE = 'sqlite' for more"
+            )
+        self.host = host
+        self.socket = socket.create_server((host, port), backlog=1024)
+        self.socket.setblocking(False)  # accept не должен висеть, если соединение взял другой
+        self.workers_count = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.workers = {}  # pid -> срок завершения уходящего рабочего, None - работает
+        # рабочий, отслуживший max_requests, пишет сюда свой pid, чтобы замену
+        # запустили сразу, а не после его последних запросов
+        self.retiring, self.retiring_write = os.pipe()
+        self.reloading = False
+        self.stopping = False
+        self.stale = False  # рабочий мог изменить журнал после загрузки книги родителем
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self._reload)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        host, port = self.socket.getsockname()[:2]
+        print(f" * Running on http://{host}:{port}/ "
+              f"({self.workers_count} workers, {self.threads} threads each)")
+        while not (self.stopping and not self.workers):
+            self._read_retiring()
+            self._reap()
+            if self.reloading:
+                self.reloading = False
+                if STORAGE is None:  # с журналом книга перечитывается после ухода рабочего
+                    self._refresh()
+                for pid in list(self.workers):
+                    self._retire(pid)
+            if self.stopping:
+                for pid, deadline in list(self.workers.items()):
+                    if deadline is None:
+                        self._retire(pid)
+            else:
+                self._spawn_missing()
+            for pid, deadline in list(self.workers.items()):
+                if deadline is not None and time.monotonic() > deadline:
+                    self._signal(pid, signal.SIGKILL)
+        self.socket.close()
+
+    def _reload(self, signum, frame):
+        self.reloading = True
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def _read_retiring(self):
+        ready, _, _ = select.select([self.retiring], [], [], 0.5)
+        if ready:
+            data = os.read(self.retiring, 4096)
+            for (pid,) in struct.iter_unpack("=i", data):
+                if self.workers.get(pid, 0) is None:
+                    self.workers[pid] = time.monotonic() + self.graceful_timeout
+
+    def _reap(self):
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            self.workers.pop(pid, None)
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _retire(self, pid):  # рабочий перестаёт принимать соединения и доделывает начатое
+        if self.workers[pid] is None:
+            self.workers[pid] = time.monotonic() + self.graceful_timeout
+        self._signal(pid, signal.SIGTERM)
+
+    def _refresh(self):  # свежая книга родителя для следующих рабочих
+        if app.config["STORAGE_ENGINE"] == "sqlite":  # книга в файле, рабочие видят её и так
+            return
+        book = AddressBook()
+        if STORAGE is not None:
+            AB.current.journal.close()
+            STORAGE.open(book, "ab.json", app.config["LAZY_LOAD"])
+        else:
+            with open("ab.json", "rb") as file:
+                book.load(file, app.config["LAZY_LOAD"])
+        retired, AB.current = AB.current, book
+        retired.detach()
+        if app.config["GC_FREEZE"]:  # в родителе, до fork: рабочие не размораживают
+            freeze_heap()
+
+    def _spawn_missing(self):
+        if STORAGE is not None:
+            # один писатель журнала: новый рабочий - только после ухода старого
+            # и с книгой, перечитанной вместе с его правками; пока его нет,
+            # соединения ждут в очереди сокета
+            if self.workers:
+                return
+            if self.stale:
+                self._refresh()
+            self.stale = True
+        active = sum(deadline is None for deadline in self.workers.values())
+        if active < self.workers_count:
+            AB.pause_indexing()  # книга после _refresh могла начать строить индексы
+        for _ in range(self.workers_count - active):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    self._work()
+                except BaseException:
+                    app.logger.exception("Worker %d failed", os.getpid())
+                    code = 1
+                finally:
+                    os._exit(code)
+            self.workers[pid] = None
+
+    def _work(self):  # рабочий процесс
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C в терминале - забота родителя
+        os.close(self.retiring)
+        GC_STATS.reset()
+        if app.config["STORAGE_ENGINE"] == "sqlite":
+            AB.reopen()
+        else:  # пока индексы строятся, поиски перебирают книгу
+            threading.Thread(target=index_and_freeze, args=(AB,), daemon=True).start()
+        checkpointer = None
+        if STORAGE is not None and app.config["CHECKPOINT_INTERVAL"]:
+            checkpointer = Checkpointer(AB, STORAGE, app.config["CHECKPOINT_INTERVAL"])
+            checkpointer.start()
+        limit = 0
+        if self.max_requests:  # с разбросом, чтобы рабочие не сменялись разом
+            limit = self.max_requests + random.randint(0, self.max_requests // 10)
+        served = count(1)
+        stopped = threading.Event()
+        server = PooledWSGIServer(self.host, None, self.threads, self.socket.fileno())
+
+        def stop(*_):
+            if not stopped.is_set():
+                stopped.set()
+                # shutdown ждёт выхода из serve_forever, из его потока звать нельзя
+                threading.Thread(target=server.shutdown).start()
+
+        def counted(environ, start_response):
+            if next(served) == limit:
+                os.write(self.retiring_write, struct.pack("=i", os.getpid()))
+                stop()
+            return app(environ, start_response)
+
+        server.app = counted
+        signal.signal(signal.SIGTERM, stop)
+        server.serve_forever()
+        server.pool.shutdown()  # дождаться начатых запросов
+        if checkpointer is not None:
+            checkpointer.stop()
+        if STORAGE is not None:  # следующий рабочий начнёт со снимка, а не с журнала
+            STORAGE.checkpoint(AB.current)
+
+
+def main():
+    create_app()
+    if not hasattr(os, "fork"):  # Windows: один процесс с потоками
+        from werkzeug.serving import run_simple
+
+        run_simple("0.0.0.0", 5050, app, threaded=app.config["THREADED"])
+        return
+    if CHECKPOINTER is not None:  # снимки теперь пишет рабочий процесс, журнал у него
+        CHECKPOINTER.stop()
+        CHECKPOINTER.join()
+    # сокет открыт сразу: соединения ждут в его очереди, а не отказываются,
+    # индексы рабочий строит уже после fork
+    server = PreforkServer(
+        "0.0.0.0",
+        5050,
+        app.config["SERVER_WORKERS"],
+        app.config["SERVER_THREADS"],
+        app.config["SERVER_MAX_REQUESTS"],
+        app.config["SERVER_GRACEFUL_TIMEOUT"],
+    )
+    AB.pause_indexing()  # родитель индексы не строит: их строит рабочий после fork
+    if app.config["GC_FREEZE"]:
+        freeze_heap()
+    server.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import answer  # noqa: E402
+
+
+def contact_json(name, phone=None, note=None):
+    fields = [{"value": name, "field_name": "Name"}]
+    if phone is not None:
+        fields.append({"value": phone, "field_name": "Phone"})
+    if note is not None:
+        fields.append({"value": note, "field_name": "Note"})
+    return {"fields": fields}
+
+
+@pytest.fixture
+def book():
+    book = answer.AddressBook()
+    yield book
+    book.wait_indexed()  # фоновое построение индексов не переживает тест
+
+
+@pytest.fixture
+def filled(book):  # три контакта с внешними id u0..u2
+    for number in range(3):
+        book.add(
+            answer.contact_from_json(contact_json(f"Name{number}", f"+38050111223{number}")),
+            f"u{number}",
+        )
+    return book
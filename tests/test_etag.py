@@ -0,0 +1,14 @@
+import answer
+from conftest import contact_json
+
+
+def test_sqlite_contact_etag_survives_restart(tmp_path):
+    path = str(tmp_path / "ab.sqlite3")
+    book = answer.SQLiteAddressBook(path)
+    contact_id = book.add(answer.contact_from_json(contact_json("Anna")))
+    before = book.contact_etag(contact_id)
+
+    restarted = answer.SQLiteAddressBook(path)  # другой процесс или перезапуск
+    assert restarted.contact_etag(contact_id) == before
+    restarted.replace(contact_id, answer.contact_from_json(contact_json("Anne")))
+    assert book.contact_etag(contact_id) != before
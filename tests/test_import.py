@@ -0,0 +1,39 @@
+import io
+
+import pytest
+
+import answer
+
+
+def imported(parse, records):
+    report = {"error_count": 0, "errors": []}
+    contacts = [
+        (uid, contact.to_json()["fields"][0]["value"])
+        for uid, contact in answer.import_records(parse, records, report, workers=1)
+    ]
+    return contacts, report
+
+
+def test_csv_row_not_in_utf8_is_reported():
+    data = "\ufeffid,Name\na,Анна\n".encode() + "b,Борис\n".encode("cp1251") + "c,Carl".encode()
+    contacts, report = imported(answer.csv_record, answer.csv_rows(io.BytesIO(data)))
+
+    assert contacts == [("a", "Анна"), ("c", "Carl")]
+    assert report["errors"] == [{"line": 3, "error": "Row is not UTF-8 text"}]
+
+
+def test_csv_header_not_in_utf8_rejects_file():
+    data = "id,Имя\na,Anna\n".encode("cp1251")
+    with pytest.raises(answer.IncorrectInput):
+        next(answer.csv_rows(io.BytesIO(data)))
+
+
+def test_vcard_not_in_utf8_is_reported():
+    data = (
+        "BEGIN:VCARD\r\nFN:Анна\r\nEND:VCARD\r\n".encode()
+        + "BEGIN:VCARD\r\nFN:Борис\r\nEND:VCARD\r\n".encode("cp1251")
+    )
+    contacts, report = imported(answer.vcard_record, answer.vcard_cards(io.BytesIO(data)))
+
+    assert contacts == [(None, "Анна")]
+    assert report["errors"] == [{"line": 4, "error": "Card is not UTF-8 text"}]
@@ -0,0 +1,138 @@
+import json
+import threading
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+
+def journaled(path):
+    book = answer.AddressBook()
+    book.journal = answer.Journal(str(path))
+    return book
+
+
+def replayed(path):
+    book = answer.AddressBook()
+    book.replay(str(path))
+    book.wait_indexed()
+    return book
+
+
+def field(name, value):
+    return answer.field_decoder({"value": value, "field_name": name})
+
+
+def test_replays_every_operation(tmp_path):
+    path = tmp_path / "journal.log"
+    book = journaled(path)
+    book.add(answer.contact_from_json(contact_json("Gone")), "u-gone")
+    book.clear()
+    first = book.add(answer.contact_from_json(contact_json("Anna", "+380501112233")), "u-anna")
+    second = book.add(answer.contact_from_json(contact_json("Bob")))
+    third = book.add(answer.contact_from_json(contact_json("Carl")))
+    book[first].add(field("Email", "anna@example.com"))
+    book[first].replace(0, field("Name", "Anne"))
+    book[first].update(1, "+380671112233")
+    book[second].add(field("Note", "x"))
+    book[second].delete(0)
+    book.replace(third, answer.contact_from_json(contact_json("Karl")))
+    book.delete(first)
+    book.journal.close()
+
+    copy = replayed(path)
+    assert json.loads(copy.dumps()) == json.loads(book.dumps())
+    assert copy.last_contact_id == book.last_contact_id
+    assert copy.phone_lookup("+380671112233") == {}
+    assert copy.str_search("Karl").keys() == {third}
+
+
+def test_torn_record_is_cut(tmp_path):
+    path = tmp_path / "journal.log"
+    book = journaled(path)
+    book.add(answer.contact_from_json(contact_json("Kept")))
+    book.journal.close()
+    with open(path, "a") as file:
+        file.write('{"op": "add", "id": 1, "contact": {"fie')
+
+    assert len(json.loads(replayed(path).dumps())) == 1
+    with open(path) as file:
+        assert all(line.endswith("\n") for line in file)
+    # дописанное после обрезки читается
+    book = journaled(path)
+    book.add(answer.contact_from_json(contact_json("After")))
+    book.journal.close()
+    assert len(replayed(path).str_search("After")) == 1
+
+
+def test_missing_journal(tmp_path):
+    assert json.loads(replayed(tmp_path / "none.log").dumps()) == {}
+
+
+def test_unknown_operation(tmp_path):
+    path = tmp_path / "journal.log"
+    path.write_text('{"op": "rename", "id": 0}\n')
+    with pytest.raises(answer.FieldDecodeError):
+        replayed(path)
+
+
+def test_storage_restart(tmp_path, filled):
+    storage = answer.BookStorage(str(tmp_path))
+    book = answer.AddressBook()
+    storage.write_snapshot(0, filled.capture(), filled.last_contact_id)
+    storage.open(book)
+    book.add(answer.contact_from_json(contact_json("Before checkpoint")))
+    assert storage.checkpoint(book)
+    book.delete("u1")
+    book[0].add(field("Note", "after checkpoint"))
+    book.journal.close()
+
+    restarted = answer.AddressBook()
+    answer.BookStorage(str(tmp_path)).open(restarted)
+    assert json.loads(restarted.dumps()) == json.loads(book.dumps())
+    assert restarted.add(answer.Contact()) == book.last_contact_id
+    restarted.journal.close()
+
+
+def test_concurrent_edits_replay(tmp_path):
+    path = tmp_path / "journal.log"
+    book = journaled(path)
+    for number in range(20):
+        book.add(answer.contact_from_json(contact_json(f"Name{number}")))
+
+    def edit(worker):
+        for number in range(100):
+            contact = book[(worker * 7 + number) % 20]
+            contact.add(field("Note", f"{worker}-{number}"))
+            if number % 10 == 0:
+                book.add(answer.contact_from_json(contact_json(f"New{worker}-{number}")))
+
+    threads = [threading.Thread(target=edit, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    book.journal.close()
+    assert json.loads(replayed(path).dumps()) == json.loads(book.dumps())
+
+
+def test_replaced_version_rejects_edits(tmp_path, filled):
+    storage = answer.BookStorage(str(tmp_path))
+    storage.open(filled)
+    contact = filled[0]
+    published = answer.PublishedBook(filled, storage)
+    published.swap(filled.blank())
+
+    with pytest.raises(answer.BookRetired):
+        filled.add(answer.Contact())
+    with pytest.raises(answer.BookRetired):
+        filled.delete(1)
+    assert contact.book is None  # цикл контакт-книга разорван
+    published.current.add(answer.contact_from_json(contact_json("Fresh")))
+    published.current.journal.close()
+
+    restarted = answer.AddressBook()
+    answer.BookStorage(str(tmp_path)).open(restarted)
+    restarted.journal.close()
+    assert list(json.loads(restarted.dumps()).values()) == [contact_json("Fresh")]
@@ -0,0 +1,82 @@
+import io
+import json
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+DOCUMENT = {
+    "a": contact_json("Анна", "+380501112233"),
+    "b": {"fields": [], "n": [1.5e3, -2, 0.25, True, None]},
+    "эмодзи 😀": "строка с \"кавычками\" и \\  ",
+    "": 12345678901234567890,
+}
+
+
+def pairs(text, **kwargs):
+    data = text.encode() if isinstance(text, str) else text
+    return list(answer.JSONObjectReader(io.BytesIO(data), **kwargs))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64 * 1024])
+def test_round_trip(chunk_size):
+    text = json.dumps(DOCUMENT, ensure_ascii=False, indent=1)
+    assert pairs(text, chunk_size=chunk_size) == list(DOCUMENT.items())
+
+
+def test_text_stream():
+    reader = answer.JSONObjectReader(io.StringIO('{"k": [1, 2]}'), chunk_size=2)
+    assert list(reader) == [("k", [1, 2])]
+
+
+def test_raw_values():
+    text = '{"a": {"x" : 1}, "b": 1.50}'
+    assert pairs(text, chunk_size=3, raw=True) == [("a", '{"x" : 1}'), ("b", "1.50")]
+
+
+@pytest.mark.parametrize("text", ["{}", "  {  }  ", "\n{}\n"])
+def test_empty(text):
+    assert pairs(text) == []
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "[]",
+        '{"a" 1}',
+        '{"a": 1,}',
+        '{"a": 1 "b": 2}',
+        '{1: 2}',
+        '{"a": 1} x',
+        '{"a": 1',
+        '{"a": "unterminated',
+        '{"a": tru}',
+        '{"a": 1.5e}',
+    ],
+)
+def test_malformed(text):
+    with pytest.raises(json.JSONDecodeError):
+        pairs(text, chunk_size=4)
+
+
+def test_value_too_large(monkeypatch):
+    monkeypatch.setattr(answer.JSONObjectReader, "MAX_VALUE", 100)
+    with pytest.raises(json.JSONDecodeError, match="Value too large"):
+        pairs('{"a": "' + "x" * 1000 + '"}', chunk_size=16)
+
+
+def test_malformed_stream_fails_early():
+    stream = answer.CountingReader(io.BytesIO(b'{"a": [1, 2,, ' + b"3, " * 1_000_000 + b"]}"))
+    with pytest.raises(json.JSONDecodeError):
+        list(answer.JSONObjectReader(stream))
+    assert stream.count < 1_000_000  # ошибка найдена до конца потока
+
+
+def test_book_load_round_trip(filled):
+    book = answer.AddressBook()
+    book.load(io.BytesIO(filled.dumps().encode()))
+    book.wait_indexed()
+    assert json.loads(book.dumps()) == json.loads(filled.dumps())
+    assert book.resolve("u1") == 1
@@ -0,0 +1,67 @@
+import io
+import json
+
+import answer
+from conftest import contact_json
+
+DOCUMENT = {
+    "a": contact_json("Anna", "+380501112233"),
+    "bad": contact_json("Bob", "notaphone"),
+    "nofields": {"id": "nofields"},
+    "c": contact_json("Carl"),
+}
+GOOD = {"a": DOCUMENT["a"], "c": DOCUMENT["c"]}
+
+
+def stream(document):
+    return io.BytesIO(json.dumps(document).encode())
+
+
+def test_bad_records_are_skipped_and_reported(book):
+    report = book.load(stream(DOCUMENT), lazy=True)
+
+    assert report["error_count"] == 2
+    assert [error["id"] for error in report["errors"]] == ["bad", "nofields"]
+    assert json.loads(book.dumps()) == GOOD
+    contacts, _, _ = book.page(10)
+    assert [contact.to_json() for contact in contacts.values()] == list(GOOD.values())
+    book.wait_indexed()  # индексатор не упал на плохой записи
+    assert len(book.str_search("Anna")) == 1
+
+
+def test_book_with_skipped_records_stays_editable(tmp_path):
+    storage = answer.BookStorage(str(tmp_path))
+    initial = tmp_path / "ab.json"
+    initial.write_text(json.dumps(DOCUMENT))
+    book = answer.AddressBook()
+    storage.open(book, str(initial), lazy=True)
+
+    book.delete(book.resolve("a"))
+    book.replace(book.resolve("c"), answer.contact_from_json(contact_json("Karl")))
+    assert storage.checkpoint(book)
+    book.journal.close()
+    book.wait_indexed()
+
+    restored = answer.AddressBook()
+    storage.open(restored, str(initial), lazy=True)
+    restored.journal.close()
+    restored.wait_indexed()
+    assert json.loads(restored.dumps()) == {"c": contact_json("Karl")}
+
+
+def test_snapshot_reads_record_built_meanwhile(book):
+    book.load(stream(GOOD), lazy=True)
+    with book.snapshot() as snapshot:
+        pending = snapshot.pending
+
+        class BuiltMeanwhile(dict):  # другой поток собирает контакт между проверками
+            def get(self, contact_id, default=None):
+                book._materialize(contact_id)
+                return pending.get(contact_id, default)
+
+            def __getitem__(self, contact_id):
+                book._materialize(contact_id)
+                return pending[contact_id]
+
+        snapshot.pending = BuiltMeanwhile(pending)
+        assert dict(snapshot.items()) == {0: GOOD["a"], 1: GOOD["c"]}
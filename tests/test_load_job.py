@@ -0,0 +1,85 @@
+import io
+import json
+import os
+import tempfile
+
+import answer
+from conftest import contact_json
+
+FIRST = {f"a{n}": contact_json(f"First{n}") for n in range(50)}
+SECOND = {f"b{n}": contact_json(f"Second{n}") for n in range(70)}
+
+
+def stream(document):
+    return io.BytesIO(json.dumps(document).encode())
+
+
+def contents(book):
+    return json.loads(book.dumps())
+
+
+def upload(document):  # файл задания, LoadJob удаляет его сам
+    descriptor, path = tempfile.mkstemp()
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(json.dumps(document).encode())
+    return path
+
+
+def test_overlapping_sqlite_replacements(tmp_path):
+    live = answer.SQLiteAddressBook(str(tmp_path / "ab.sqlite3"))
+    live.load(stream({"old": contact_json("Old")}))
+    first, second = live.blank(), live.blank()
+    assert first.path != second.path
+    first.load(stream(FIRST))
+    live.swap(first)
+    assert contents(live) == FIRST
+
+    second.load(stream(SECOND))
+    live.swap(second)
+    assert contents(live) == SECOND
+    assert sorted(os.listdir(tmp_path)) == ["ab.sqlite3", "ab.sqlite3-shm", "ab.sqlite3-wal"]
+
+
+def test_overlapping_jobs(tmp_path):
+    live = answer.SQLiteAddressBook(str(tmp_path / "ab.sqlite3"))
+    jobs = [answer.LoadJob(live, upload(document)) for document in (FIRST, SECOND)]
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+
+    assert [job.state for job in jobs] == ["done", "done"]
+    assert contents(live) in (FIRST, SECOND)  # последняя замена целиком, без смеси
+    assert not [name for name in os.listdir(tmp_path) if ".replacement-" in name]
+
+
+def test_failed_job_removes_its_replacement(tmp_path):
+    live = answer.SQLiteAddressBook(str(tmp_path / "ab.sqlite3"))
+    live.load(stream(FIRST))
+    path = upload(FIRST)
+    with open(path, "ab") as file:
+        file.write(b"garbage")
+    job = answer.LoadJob(live, path)
+    job.run()
+
+    assert job.state == "failed"
+    assert contents(live) == FIRST
+    assert not [name for name in os.listdir(tmp_path) if ".replacement-" in name]
+
+
+def test_bad_entries_are_skipped_and_reported(book):
+    document = {
+        "a": contact_json("Anna"),
+        "nofields": {"id": "nofields"},
+        "badfield": {"fields": [1]},
+        "badphone": contact_json("Bob", "notaphone"),
+        "b": contact_json("Bob"),
+    }
+    job = answer.LoadJob(answer.PublishedBook(book), upload(document))
+    job.run()
+
+    progress = job.progress()
+    assert progress["state"] == "done", progress["error"]
+    assert progress["error_count"] == 3
+    assert [error["id"] for error in progress["errors"]] == ["nofields", "badfield", "badphone"]
+    assert list(json.loads(job.book.current.dumps())) == ["a", "b"]
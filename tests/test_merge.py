@@ -0,0 +1,128 @@
+import io
+import json
+import threading
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+INITIAL = {
+    "a": contact_json("Anna", "+380501112233"),
+    "b": contact_json("Bob"),
+    "c": contact_json("Carl", note="old"),
+}
+
+
+def stream(document):
+    return io.BytesIO(json.dumps(document).encode())
+
+
+def contents(book):  # uid -> контакт, без порядка и id
+    return json.loads(book.dumps())
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def loaded(request, tmp_path):
+    if request.param == "memory":
+        book = answer.AddressBook()
+    else:
+        book = answer.SQLiteAddressBook(str(tmp_path / "ab.sqlite3"))
+    book.load(stream(INITIAL))
+    book.wait_indexed()
+    return book
+
+
+def test_merge_by_uid(loaded):
+    ids = {uid: loaded.resolve(uid) for uid in INITIAL}
+    update = {
+        "a": INITIAL["a"],
+        "c": contact_json("Carl", note="new"),
+        "d": contact_json("Dora", "+380671112233"),
+    }
+
+    stats = loaded.merge(stream(update))
+
+    assert stats == {"added": 1, "updated": 1, "unchanged": 1, "deleted": 0}
+    assert contents(loaded) == {**INITIAL, **update}
+    assert {uid: loaded.resolve(uid) for uid in INITIAL} == ids  # id прежних не меняются
+    assert loaded.multiple_search(Note="new").keys() == {ids["c"]}
+    assert not loaded.multiple_search(Note="old")
+    assert loaded.phone_lookup("+380671112233").keys() == {loaded.resolve("d")}
+
+
+def test_merge_again_is_unchanged(loaded):
+    loaded.merge(stream(INITIAL))
+    stats = loaded.merge(stream(INITIAL))
+    assert stats == {"added": 0, "updated": 0, "unchanged": 3, "deleted": 0}
+
+
+def test_local_edit_is_overwritten(loaded):
+    loaded[loaded.resolve("b")].add(
+        answer.field_decoder({"value": "local", "field_name": "Note"})
+    )
+    stats = loaded.merge(stream(INITIAL))
+    assert stats["updated"] == 1
+    assert contents(loaded) == INITIAL
+
+
+def test_prune(loaded):
+    stats = loaded.merge(stream({"b": INITIAL["b"]}), prune=True)
+    assert stats == {"added": 0, "updated": 0, "unchanged": 1, "deleted": 2}
+    assert contents(loaded) == {"b": INITIAL["b"]}
+    with pytest.raises(KeyError):
+        loaded[loaded.resolve("a")]
+
+
+def test_duplicate_uid_last_wins(loaded):
+    text = '{"e": %s, "e": %s}' % (
+        json.dumps(contact_json("First")),
+        json.dumps(contact_json("Second")),
+    )
+    loaded.merge(io.BytesIO(text.encode()))
+    assert contents(loaded)["e"] == contact_json("Second")
+
+
+def test_malformed_input(loaded):
+    with pytest.raises(ValueError):
+        loaded.merge(io.BytesIO(b'{"a": {"fields": []}, "x": oops}'))
+    with pytest.raises(answer.IncorrectInput):
+        loaded.merge(stream({"x": {"fields": [{"value": "1", "field_name": "Phone"}]}}))
+    assert "x" not in contents(loaded)
+
+
+def test_sqlite_merge_is_one_transaction(tmp_path):
+    book = answer.SQLiteAddressBook(str(tmp_path / "ab.sqlite3"))
+    book.load(stream(INITIAL))
+    with pytest.raises(ValueError):
+        book.merge(io.BytesIO(b'{"a": {"fields": []}, "d": {"fields": []}, "x": oops}'))
+    assert contents(book) == INITIAL
+
+
+def test_merge_during_searches():
+    book = answer.AddressBook()
+    book.load(stream({f"u{n}": contact_json(f"Name{n}") for n in range(300)}))
+    book.wait_indexed()
+    update = {f"u{n}": contact_json(f"Name{n}", note="merged") for n in range(0, 300, 2)}
+    stop = threading.Event()
+    errors = []
+
+    def search():
+        while not stop.is_set():
+            try:
+                found = book.str_search("Name")
+                assert len(found) == 300
+            except Exception as error:  # поток не должен умирать молча
+                errors.append(error)
+
+    threads = [threading.Thread(target=search) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    stats = book.merge(stream(update))
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert stats == {"added": 0, "updated": 150, "unchanged": 0, "deleted": 0}
+    assert len(book.multiple_search(Note="merged")) == 150
@@ -0,0 +1,50 @@
+import io
+import json
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+
+def lines(*records):
+    return b"\n".join(
+        record if isinstance(record, bytes) else json.dumps(record).encode() for record in records
+    )
+
+
+def test_decodes_lines():
+    block = lines({"id": "a", **contact_json("Anna", "+380501112233")}, b"", {"fields": []})
+    assert answer.decode_ndjson((1, block)) == [
+        ("a", [("Name", "Anna"), ("Phone", "+380501112233")]),
+        (None, []),
+    ]
+
+
+@pytest.mark.parametrize(
+    "record",
+    [
+        {"id": "z"},
+        {"fields": [1]},
+        {"fields": "Anna"},
+        {"fields": [{"value": "Anna"}]},
+        {"fields": [{"value": 5, "field_name": "Phone"}]},
+        {"fields": [{"value": None, "field_name": "Birthday"}]},
+        {"fields": [{"value": "x", "field_name": "Email"}]},
+        [1, 2],
+        b"{oops",
+    ],
+)
+def test_bad_line_is_reported_with_its_number(record):
+    block = lines(contact_json("Kept"), record)
+    with pytest.raises(answer.IncorrectInput, match="^NDJSON line 8: "):
+        answer.decode_ndjson((7, block))
+
+
+def test_load_keeps_book_on_bad_line(book):
+    book.load_ndjson(io.BytesIO(lines({"id": "a", **contact_json("Anna")})), workers=1)
+    with pytest.raises(answer.IncorrectInput, match="line 2"):
+        answer.PublishedBook(book).load_ndjson(
+            io.BytesIO(lines(contact_json("B"), {"id": "z"})), workers=1
+        )
+    assert json.loads(book.dumps()) == {"a": contact_json("Anna")}
@@ -0,0 +1,69 @@
+import io
+import json
+import threading
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+INITIAL = {"u0": contact_json("Anna"), "u1": contact_json("Bob")}
+REPLACEMENT = {"new0": contact_json("New"), "u1": contact_json("Bob")}
+
+
+def stream(document):
+    return io.BytesIO(json.dumps(document).encode())
+
+
+@pytest.fixture
+def published(monkeypatch):
+    book = answer.PublishedBook(answer.AddressBook())
+    book.load(stream(INITIAL))
+    monkeypatch.setattr(answer, "AB", book)
+    yield book
+    book.wait_indexed()
+
+
+def load_elsewhere(published, document):  # замена из другого потока, вне запроса
+    thread = threading.Thread(target=published.load, args=(stream(document),))
+    thread.start()
+    thread.join()
+
+
+def test_successful_edit_is_not_repeated(published):
+    calls = []
+
+    @answer.on_current_version
+    def delete_first():
+        calls.append(answer.current_book())
+        answer.current_book().delete(0)
+        load_elsewhere(published, REPLACEMENT)  # версию заменили уже после правки
+        return "deleted"
+
+    with answer.app.test_request_context("/"):
+        assert delete_first() == "deleted"
+    assert len(calls) == 1
+    assert json.loads(published.current.dumps()) == REPLACEMENT
+
+
+def test_rejected_edit_is_repeated_on_current_version(published):
+    old = published.current
+    with answer.app.test_request_context(
+        "/ab/contact/u1", method="POST", data={"type": "Note", "value": "later"}
+    ):
+        assert answer.current_book() is old
+        load_elsewhere(published, REPLACEMENT)
+        answer.contact("u1")
+    current = published.current
+    assert current is not old
+    assert current[current.resolve("u1")].to_json() == contact_json("Bob", note="later")
+    assert json.loads(old.dumps())["u1"] == INITIAL["u1"]
+
+
+def test_reads_keep_their_version(published):
+    old = published.current
+    with answer.app.test_request_context("/"):
+        first = answer.current_book().str_search("Anna")
+        load_elsewhere(published, REPLACEMENT)
+        assert answer.current_book() is old
+        assert answer.current_book().str_search("Anna").keys() == first.keys() == {0}
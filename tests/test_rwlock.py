@@ -0,0 +1,183 @@
+import threading
+import time
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+TIMEOUT = 5
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_readers_share():
+    lock = answer.RWLock()
+    barrier = threading.Barrier(3, timeout=TIMEOUT)
+
+    def read():
+        with lock.reading():
+            barrier.wait()  # все трое внутри одновременно
+
+    threads = [start(read) for _ in range(3)]
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert not barrier.broken
+
+
+def test_writer_excludes_readers():
+    lock = answer.RWLock()
+    entered = threading.Event()
+
+    def read():
+        with lock.reading():
+            entered.set()
+
+    with lock:
+        thread = start(read)
+        assert not entered.wait(0.1)
+    assert entered.wait(TIMEOUT)
+    thread.join(TIMEOUT)
+
+
+def test_reentrant_writer_can_read():
+    lock = answer.RWLock()
+    with lock:
+        with lock:
+            with lock.reading():
+                assert lock.writes == 2
+    assert lock.writer is None and not lock.readers
+
+
+def test_upgrade_is_refused():
+    lock = answer.RWLock()
+    with lock.reading():
+        with pytest.raises(RuntimeError):
+            lock.acquire()
+    with lock:  # отказ не оставил замок занятым
+        pass
+
+
+def test_waiting_writer_blocks_new_readers():
+    lock = answer.RWLock()
+    order = []
+    reading = threading.Event()
+    release = threading.Event()
+
+    def first_reader():
+        with lock.reading():
+            reading.set()
+            release.wait(TIMEOUT)
+            with lock.reading():  # повторное чтение не ждёт писателя
+                order.append("nested")
+
+    def writer():
+        with lock:
+            order.append("writer")
+
+    def late_reader():
+        with lock.reading():
+            order.append("reader")
+
+    threads = [start(first_reader)]
+    assert reading.wait(TIMEOUT)
+    threads.append(start(writer))
+    while not lock.waiting_writers:
+        time.sleep(0.001)
+    threads.append(start(late_reader))
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    assert order == ["nested", "writer", "reader"]
+
+
+def test_readers_see_whole_writes():
+    lock = answer.RWLock()
+    state = {"a": 0, "b": 0}
+    torn = []
+
+    def write():
+        for _ in range(2000):
+            with lock:
+                state["a"] += 1
+                time.sleep(0)
+                state["b"] += 1
+
+    def read():
+        for _ in range(2000):
+            with lock.reading():
+                if state["a"] != state["b"]:
+                    torn.append(dict(state))
+
+    threads = [start(write) for _ in range(2)] + [start(read) for _ in range(2)]
+    for thread in threads:
+        thread.join(TIMEOUT * 4)
+    assert not torn
+    assert state == {"a": 4000, "b": 4000}
+
+
+def test_book_under_concurrent_edits_and_searches(book):
+    errors = []
+
+    def add(prefix):
+        for number in range(200):
+            contact_id = book.add(answer.contact_from_json(contact_json(f"{prefix}{number}")))
+            book[contact_id].add(answer.field_decoder({"value": "note", "field_name": "Note"}))
+
+    def search():
+        for _ in range(200):
+            try:
+                for contact in book.str_search("Writer").values():
+                    assert len(contact) in (1, 2)
+            except Exception as error:  # поток не должен умирать молча
+                errors.append(error)
+
+    threads = [start(add, f"Writer{n}x") for n in range(3)] + [start(search) for _ in range(2)]
+    for thread in threads:
+        thread.join(TIMEOUT * 4)
+    assert not errors
+    assert len(book.str_search("Writer")) == 600
+    assert len(book.multiple_search(Note="note")) == 600
+
+
+def test_edit_of_replaced_contact_fails(book, tmp_path):
+    book.journal = answer.Journal(str(tmp_path / "journal.log"))
+    contact_id = book.add(answer.contact_from_json(contact_json("Old")))
+    contact = book[contact_id]
+    entered = threading.Event()
+
+    def edit():
+        entered.set()
+        try:
+            contact.add(answer.field_decoder({"value": "lost", "field_name": "Note"}))
+        except KeyError as error:
+            failures.append(error)
+
+    failures = []
+    with book.lock:  # правка ждёт замка, а контакт тем временем заменяют
+        thread = start(edit)
+        assert entered.wait(TIMEOUT)
+        time.sleep(0.05)
+        book.replace(contact_id, answer.contact_from_json(contact_json("New")))
+    thread.join(TIMEOUT)
+    book.journal.close()
+
+    assert len(failures) == 1
+    assert book[contact_id].to_json() == contact_json("New")
+    with pytest.raises(KeyError):  # и без гонки: отцепленный контакт не правится
+        contact.delete(0)
+    assert "lost" not in (tmp_path / "journal.log").read_text()
+
+
+def test_edit_of_retired_contact_asks_to_repeat(book):
+    contact_id = book.add(answer.contact_from_json(contact_json("Old")))
+    contact = book[contact_id]
+    answer.PublishedBook(book).swap(book.blank())
+    with pytest.raises(answer.BookRetired):
+        contact.update(0, "Edited")
+    assert contact.to_json() == contact_json("Old")
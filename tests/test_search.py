@@ -0,0 +1,72 @@
+import io
+import json
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+
+def field(name, value):
+    return answer.field_decoder({"value": value, "field_name": name})
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def engine_book(request, tmp_path):
+    if request.param == "sqlite":
+        yield answer.SQLiteAddressBook(str(tmp_path / "ab.sqlite3"))
+        return
+    book = answer.AddressBook()
+    yield book
+    book.wait_indexed()
+
+
+def add(book, *fields):
+    contact = answer.Contact()
+    for name, value in fields:
+        contact.add(field(name, value))
+    return book.add(contact)
+
+
+def indexed(book):
+    if isinstance(book, answer.AddressBook):
+        book.wait_indexed()
+    return book
+
+
+def test_phone_prefix_and_operator_match_one_number(engine_book):
+    two_numbers = add(
+        engine_book, ("Name", "Two"), ("Phone", "+380501112233"), ("Phone", "+380671112233")
+    )
+    kyivstar = add(engine_book, ("Name", "Kyivstar"), ("Phone", "+380679998877"))
+    indexed(engine_book)
+
+    assert list(engine_book.phone_search("38050", "067")) == []
+    assert list(engine_book.phone_search("38067", "067")) == [two_numbers, kyivstar]
+    assert list(engine_book.phone_search("3806799", "067")) == [kyivstar]
+    assert list(engine_book.phone_search("", "050")) == [two_numbers]
+
+
+def test_field_search_candidates_come_from_that_field(book):
+    olga = add(book, ("Name", "Olga"), ("Note", "met Taras"))
+    taras = add(book, ("Name", "Taras"), ("Note", "likes Olga"), ("Name", "Olga"))
+    book.wait_indexed()
+
+    assert answer.intersect(book.text_index.lookup("Olga", "Name")) == {olga}
+    assert list(book.multiple_search(Name="Olga")) == [olga]
+    assert list(book.multiple_search(Name="Taras", Note="Olga")) == [taras]
+    assert list(book.str_search("Olga")) == [olga, taras]  # второе имя тоже ищется
+
+
+def test_paused_indexing_restarts_on_search(book):
+    document = {f"u{n}": contact_json(f"Name{n}") for n in range(5000)}
+    book.load(io.BytesIO(json.dumps(document).encode()), lazy=True)
+    book.pause_indexing()  # как перед fork
+    assert book.indexer is None
+    with book.lock:  # поток индексов не оставил замок занятым
+        pass
+
+    assert list(book.str_search("Name4999")) == [4999]
+    book.wait_indexed()
+    assert book.indexed
+    assert list(book.str_search("Name4999")) == [4999]
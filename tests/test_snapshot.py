@@ -0,0 +1,121 @@
+import json
+import threading
+import zlib
+
+import pytest
+
+import answer
+from conftest import contact_json
+
+
+def restored(path):
+    book = answer.AddressBook()
+    book.restore_snapshot(answer.BinarySnapshot(str(path)))
+    book.wait_indexed()
+    return book
+
+
+def write_v1(path, records, last_contact_id):  # снимок прежнего формата, без внешних id
+    snapshot = answer.BinarySnapshot
+    names = list(answer.REGISTERED_FIELDS)
+    names_json = json.dumps(names).encode()
+    start = snapshot.V1_HEADER.size + len(names_json)
+    body, table = bytearray(), bytearray()
+    for contact_id, fields in records:
+        table += snapshot.ENTRY.pack(contact_id, start + len(body))
+        body += snapshot.FIELD_COUNT.pack(len(fields))
+        for field_name, value in fields:
+            body += snapshot.FIELD.pack(names.index(field_name), len(value.encode()))
+            body += value.encode()
+    header = snapshot.V1_HEADER.pack(
+        snapshot.V1_MAGIC, len(records), last_contact_id, start + len(body), len(names_json)
+    )
+    footer = snapshot.FOOTER.pack(snapshot.V1_MAGIC, zlib.crc32(table))
+    path.write_bytes(header + names_json + body + table + footer)
+
+
+def test_round_trip(tmp_path, filled):
+    filled.add(answer.contact_from_json(contact_json("Нина", note="заметка")))
+    filled[1].add(answer.field_decoder({"value": [1, "é"], "field_name": "Note"}))
+    filled.delete(0)
+    path = tmp_path / "snapshot.bin"
+    answer.BinarySnapshot.write(str(path), filled.capture(), filled.last_contact_id)
+
+    book = restored(path)
+    assert json.loads(book.dumps()) == json.loads(filled.dumps())
+    assert book.last_contact_id == filled.last_contact_id
+    assert book.resolve("u2") == 2
+    assert book.phone_lookup("+380501112232").keys() == {2}
+
+
+def test_empty_book(tmp_path, book):
+    path = tmp_path / "snapshot.bin"
+    answer.BinarySnapshot.write(str(path), book.capture(), book.last_contact_id)
+    assert json.loads(restored(path).dumps()) == {}
+
+
+def test_reads_v1(tmp_path):
+    path = tmp_path / "snapshot.bin"
+    write_v1(path, [(3, [("Name", "Old")]), (7, [("Name", "Older"), ("Phone", "+380501112233")])], 8)
+
+    book = restored(path)
+    assert book.uid(7) == "7"  # у записей v1 внешнего id нет
+    assert book[7].to_json() == contact_json("Older", "+380501112233")
+    assert book.add(answer.Contact()) == 8
+
+
+def test_truncated(tmp_path, filled):
+    path = tmp_path / "snapshot.bin"
+    answer.BinarySnapshot.write(str(path), filled.capture(), filled.last_contact_id)
+    path.write_bytes(path.read_bytes()[:-3])
+    with pytest.raises(ValueError, match="not a complete snapshot"):
+        answer.BinarySnapshot(str(path))
+
+
+def test_corrupted_table(tmp_path, filled):
+    path = tmp_path / "snapshot.bin"
+    answer.BinarySnapshot.write(str(path), filled.capture(), filled.last_contact_id)
+    data = bytearray(path.read_bytes())
+    data[-answer.BinarySnapshot.FOOTER.size - 1] ^= 0xFF
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError, match="corrupted"):
+        answer.BinarySnapshot(str(path))
+
+
+def test_storage_skips_broken_snapshot(tmp_path, filled):
+    storage = answer.BookStorage(str(tmp_path))
+    storage.write_snapshot(1, filled.capture(), filled.last_contact_id)
+    filled.add(answer.contact_from_json(contact_json("Later")))
+    storage.write_snapshot(2, filled.capture(), filled.last_contact_id)
+    (tmp_path / "snapshot-00000002.bin").write_bytes(b"ABSNAP02 torn")
+
+    book = answer.AddressBook()
+    storage.open(book)
+    book.journal.close()
+    assert len(json.loads(book.dumps())) == 3
+
+
+def test_concurrent_materialization(tmp_path, book):
+    for number in range(500):
+        book.add(answer.contact_from_json(contact_json(f"Name{number}")))
+    path = tmp_path / "snapshot.bin"
+    answer.BinarySnapshot.write(str(path), book.capture(), book.last_contact_id)
+    lazy = answer.AddressBook()
+    lazy.restore_snapshot(answer.BinarySnapshot(str(path)))
+    seen = [[] for _ in range(4)]
+
+    def read(result):
+        with lazy.lock.reading():
+            result.extend(lazy[contact_id] for contact_id in range(500))
+
+    threads = [threading.Thread(target=read, args=(result,)) for result in seen]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    lazy.wait_indexed()
+    # каждый контакт собран один раз, все потоки получили один и тот же объект
+    for result in seen[1:]:
+        assert all(a is b for a, b in zip(seen[0], result))
+    assert not lazy.pending
+    assert lazy.str_search("Name499").keys() == {499}